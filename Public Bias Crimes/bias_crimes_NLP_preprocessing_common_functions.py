@@ -1,19 +1,92 @@
-import nltk
-
-nltk.download('stopwords', quiet=True)
-nltk.download('omw-1.4')    
-nltk.download('averaged_perceptron_tagger', quiet=True)
-nltk.download('wordnet', quiet=True)
-
+import os
 import re
 import string
-from nltk.corpus import stopwords
-from nltk.stem.wordnet import WordNetLemmatizer
-from nltk import pos_tag
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+# NLTK itself takes about a second to import and its corpora and tagger are
+# loaded from disk, so both are deferred to the first call that needs them.
+# Nothing is downloaded at import time; run provisionResources() once per host
+# (or per image) to fetch the resources.
+
+# Local directory searched for NLTK resources before NLTK's default locations
+nltk_data_dir = os.environ.get('BIAS_CRIMES_NLTK_DATA')
+
+# (download name, resource paths that satisfy it)
+nltk_resources = [
+    ('stopwords', ['corpora/stopwords']),
+    ('omw-1.4', ['corpora/omw-1.4']),
+    ('wordnet', ['corpora/wordnet']),
+    ('averaged_perceptron_tagger', ['taggers/averaged_perceptron_tagger',
+                                    'taggers/averaged_perceptron_tagger_eng']),
+]
+
+_nltk = None
+
+def _add_data_dir(nltk, data_dir):
+    if data_dir is not None and data_dir not in nltk.data.path:
+        nltk.data.path.insert(0, data_dir)
+
+def missingResources(data_dir=None):
+    """Returns the download names of the NLTK resources that cannot be found
+    locally. Never touches the network."""
+    import nltk
+    _add_data_dir(nltk, data_dir or nltk_data_dir)
+    missing = []
+    for name, paths in nltk_resources:
+        found = False
+        for path in paths:
+            try:
+                nltk.data.find(path)
+                found = True
+                break
+            except LookupError:
+                continue
+        if not found:
+            missing.append(name)
+    return missing
+
+def provisionResources(download_dir=None, quiet=True):
+    """Downloads the NLTK resources used by this module. Run once per host,
+    e.g. when building the inference image, not in every process.
+
+    Args:
+        download_dir (str): where to put the resources, defaults to
+                            BIAS_CRIMES_NLTK_DATA or NLTK's default directory
+        quiet (bool): passed to nltk.download
+
+    Returns:
+        list of resources that are still missing afterwards
+    """
+    import nltk
+    download_dir = download_dir or nltk_data_dir
+    for name, _ in nltk_resources:
+        nltk.download(name, download_dir=download_dir, quiet=quiet)
+    # newer NLTK releases load the tagger under this name
+    nltk.download('averaged_perceptron_tagger_eng', download_dir=download_dir, quiet=quiet)
+    return missingResources(download_dir)
+
+def _load_nltk():
+    """Imports NLTK on first use and checks its resources are available
+    locally. Raises LookupError instead of downloading them."""
+    global _nltk
+    if _nltk is None:
+        import nltk
+        import nltk.corpus
+        import nltk.stem.wordnet
+        import nltk.tag
+        missing = missingResources()
+        if missing:
+            raise LookupError(
+                f"NLTK resources {missing} not found in {nltk.data.path}. "
+                "Run provisionResources() once, or set BIAS_CRIMES_NLTK_DATA to a directory holding them.")
+        _nltk = nltk
+    return _nltk
 
 # Defining pre-processing functions
 def removeStopWords(data_str):
-    stops = set(stopwords.words("english"))
+    stops = set(_load_nltk().corpus.stopwords.words("english"))
     cleaned_str = []
         
     for word in data_str.split():
@@ -54,9 +127,10 @@ def removeFeatures(data_str):
     return ' '.join(cleaned_str)
 
 def lemmatize(data_str):
+    nltk = _load_nltk()
     cleaned_str = []
-    lmtzr = WordNetLemmatizer()
-    tagged_words = pos_tag(data_str.split())
+    lmtzr = nltk.stem.wordnet.WordNetLemmatizer()
+    tagged_words = nltk.pos_tag(data_str.split())
         
     for word in tagged_words:
         if 'v' in word[1].lower():
@@ -67,3 +141,152 @@ def lemmatize(data_str):
         
     return ' '.join(cleaned_str)
 
+
+class narrative_preprocessor():
+    """Preprocessing engine for bias crime narratives.
+
+    Does the same work as removeStopWords, removeFeatures and lemmatize, with
+    identical output so the saved countvectorizer.pkl vocabulary still lines up,
+    but builds its resources once instead of on every call:
+    - the English stopword set
+    - the compiled regexes and punctuation table
+    - one WordNetLemmatizer and one POS tagger
+    - a bounded memo of lemmas keyed by (word, POS)
+
+    Usage:
+    preprocessor = narrative_preprocessor()
+    df['corpus'] = preprocessor.preprocessBatch(df['narrative'])
+    """
+    def __init__(self, lemma_cache_size=100000):
+        nltk = _load_nltk()
+        self.stops = set(nltk.corpus.stopwords.words("english"))
+        self.url_re = re.compile(r'https?://(www.)?\w+\.\w+(/\w+)*/?')
+        self.num_re = re.compile(r'\d+')
+        self.mention_re = re.compile(r'@\w+')
+        self.alpha_num_re = re.compile("^[a-z0-9_.]+$")
+        self.punctuation_table = str.maketrans('', '', string.punctuation)
+        self.lmtzr = nltk.stem.wordnet.WordNetLemmatizer()
+        self.tagger = nltk.tag.PerceptronTagger()
+        self._lemma = lru_cache(maxsize=lemma_cache_size)(self.lmtzr.lemmatize)
+
+    def removeStopWords(self, data_str):
+        """Same output as removeStopWords()."""
+        return ' '.join(word for word in data_str.split() if word not in self.stops)
+
+    def removeFeatures(self, data_str):
+        """Same output as removeFeatures()."""
+        data_str = data_str.lower()
+        data_str = data_str.translate(self.punctuation_table)
+        data_str = self.url_re.sub(' ', data_str)
+        data_str = self.mention_re.sub(' ', data_str)
+        data_str = self.num_re.sub(' ', data_str)
+        return ' '.join(word for word in data_str.split()
+                        if self.alpha_num_re.match(word) and len(word) > 2)
+
+    def lemmatizeTagged(self, tagged_words):
+        """Lemmatizes a list of (word, tag) pairs as lemmatize() does."""
+        cleaned_str = []
+        for word, tag in tagged_words:
+            if 'v' in tag.lower():
+                cleaned_str.append(self._lemma(word, 'v'))
+            else:
+                cleaned_str.append(self._lemma(word, 'n'))
+        return ' '.join(cleaned_str)
+
+    def lemmatize(self, data_str):
+        """Same output as lemmatize()."""
+        return self.lemmatizeTagged(self.tagger.tag(data_str.split()))
+
+    def preprocess(self, data_str):
+        """Runs removeStopWords -> removeFeatures -> lemmatize on one narrative,
+        in the order the feature engineering notebooks apply them."""
+        return self.lemmatize(self.removeFeatures(self.removeStopWords(data_str)))
+
+    def preprocessBatch(self, narratives):
+        """Preprocesses many narratives, tagging them as one batch of sentences.
+        Returns a list of cleaned strings in the same order."""
+        cleaned = [self.removeFeatures(self.removeStopWords(data_str)) for data_str in narratives]
+        tagged = self.tagger.tag_sents([data_str.split() for data_str in cleaned])
+        return [self.lemmatizeTagged(tagged_words) for tagged_words in tagged]
+
+
+
+# One preprocessor per pool worker, built by _init_worker so the NLTK
+# resources are loaded once per process rather than once per chunk
+_worker_preprocessor = None
+
+def _init_worker(lemma_cache_size):
+    global _worker_preprocessor
+    _worker_preprocessor = narrative_preprocessor(lemma_cache_size)
+
+def _preprocess_chunk(narratives):
+    return _worker_preprocessor.preprocessBatch(narratives)
+
+def preprocessNarrativeFile(input_path, output_path, narrative_col='narrative',
+                            id_cols=('reporting_event_number', 'report_id'),
+                            chunksize=1000, n_workers=None, max_pending=None,
+                            fill_value='narrative', lemma_cache_size=100000):
+    """Streams narratives from input_path through a process pool and writes the
+    cleaned corpus to output_path.
+
+    The csv is read chunksize rows at a time and each chunk is cleaned by a pool
+    worker with narrative_preprocessor.preprocessBatch. At most max_pending chunks
+    are in flight, and finished chunks are appended to output_path in input order
+    as soon as they are ready, so memory stays bounded by the chunk size rather
+    than the number of reports.
+
+    Args:
+        input_path (str): narratives csv, e.g. narratives.csv
+        output_path (str): csv written with id_cols and a 'corpus' column
+        narrative_col (str): column holding the raw narrative
+        id_cols (sequence): columns copied to the output to merge the corpus back on
+        chunksize (int): rows per chunk
+        n_workers (int): pool size, defaults to the number of cpus
+        max_pending (int): chunks in flight, defaults to 2 * n_workers
+        fill_value (str): replaces missing narratives and empty corpora, as the
+                          feature engineering notebooks do. None leaves them as is.
+        lemma_cache_size (int): lemma memo size of each worker
+
+    Returns:
+        number of narratives written
+    """
+    import pandas as pd
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * n_workers
+    id_cols = list(id_cols)
+    reader = pd.read_csv(input_path, usecols=id_cols + [narrative_col], chunksize=chunksize)
+    pending = deque()
+    n_written = 0
+    header = True
+
+    def write(chunk, corpus):
+        nonlocal n_written, header
+        out = chunk[id_cols].copy()
+        out['corpus'] = corpus
+        if fill_value is not None:
+            out['corpus'] = out['corpus'].replace('', fill_value)
+        out.to_csv(output_path, mode='w' if header else 'a', header=header, index=False)
+        header = False
+        n_written += len(out)
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                             initargs=(lemma_cache_size,)) as executor:
+        for chunk in reader:
+            narratives = chunk[narrative_col]
+            if fill_value is not None:
+                narratives = narratives.fillna(fill_value)
+            pending.append((chunk, executor.submit(_preprocess_chunk, narratives.tolist())))
+            if len(pending) >= max_pending:
+                done_chunk, future = pending.popleft()
+                write(done_chunk, future.result())
+        while pending:
+            done_chunk, future = pending.popleft()
+            write(done_chunk, future.result())
+
+    if header:
+        # nothing was read, still leave a valid file behind
+        pd.DataFrame(columns=id_cols + ['corpus']).to_csv(output_path, index=False)
+    return n_written
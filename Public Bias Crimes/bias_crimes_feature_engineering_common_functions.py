@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+
+# dictionary of ranked crime descriptions
+offense_code_ranks = {"RCW - 9A.36.080 | HATE CRIME OFFENSE": 1,
+    "RCW - 9A.36.080 | MALICIOUS HARASSMENT": 2,
+    "SMC - - 12A.06.115 | MALICIOUS HARASSMENT": 3,
+    "Incident Contains Bias Elements -- NO CRIME": 4,
+    "Offense Contains Bias Elements -- CRIME": 5,
+    "X91 | MALICIOUS HARASSMENT": 6,
+    "X92 | BIAS INCIDENT": 7}
+
+# common columns taken from the first row of each report
+report_columns = ['reporting_event_number', 'report_id', 'precinct', 'beat', 'event_start_date',
+                  'report_submitted_date', 'approval_status', 'report_ucr_approved_by']
+
+# columns flattened to <column>_0, <column>_1, ... per report
+flatten_columns = ['offense_id', 'crime_description', 'victim_personid', 'victim_age', 'victim_race',
+                   'victim_gender', 'victim_ethnicity', 'subject_personid', 'subject_age', 'subject_race',
+                   'subject_gender', 'subject_ethnicity', 'offense_rank', 'demographics_rank']
+
+unknown_values = ["Unknown", "-"]
+
+
+def offenseRank(crime_description):
+    """Ranks crime descriptions by offense_code_ranks: 8 for any other
+    description and 9 for '-'."""
+    rank = crime_description.map(offense_code_ranks)
+    rank = rank.mask(crime_description == '-', 9)
+    return rank.fillna(8).astype(np.int64)
+
+def _is_known(values):
+    # same test as `value not in ["Unknown", None, "-"]`: a missing value read
+    # as NaN counts as known, only an actual None does not
+    known = ~values.isin(unknown_values).to_numpy()
+    if values.dtype == object:
+        known &= ~np.equal(values.to_numpy(), None)
+    return known
+
+def completenessScore(df, prefix):
+    """Counts how many of <prefix>_age, _race, _gender and _ethnicity are filled
+    in for each row. An age of -1 is unknown."""
+    age = df[f'{prefix}_age']
+    score = (age.notna() & (age != -1)).to_numpy(dtype=np.int64)
+    for field in ['race', 'gender', 'ethnicity']:
+        score = score + _is_known(df[f'{prefix}_{field}'])
+    return pd.Series(score, index=df.index)
+
+def completenessRank(df, prefix):
+    """Dense ranks the rows of each report by completenessScore, most complete
+    first, so rows with the same completeness get the same rank."""
+    score = completenessScore(df, prefix)
+    return score.groupby(df['report_id']).rank(ascending=False, method='dense').astype(int)
+
+def rankDemographics(df):
+    """Adds demographics_rank (victim rank + subject rank) to the rows of
+    incident_offense and sorts them the way the inference notebook did with
+    its grouped, row-wise ranking: report_id descending, then subject rank,
+    then victim rank, keeping the input order for ties."""
+    df = df.reset_index(drop=True)
+    df['victim_rank'] = completenessRank(df, 'victim')
+    df.sort_values(['report_id', 'victim_rank'], ascending=False, inplace=True)
+    df = df.reset_index(drop=True)
+    df['subject_rank'] = completenessRank(df, 'subject')
+    df.sort_values(['report_id', 'subject_rank'], ascending=False, inplace=True)
+
+    #create subject + victim rank
+    df['demographics_rank'] = df['victim_rank'] + df['subject_rank']
+    #drop individual ranks (we'll use the combined rank)
+    return df.drop(['victim_rank', 'subject_rank'], axis=1)
+
+def flattenReports(df):
+    """Flattens the ranked rows to one row per report.
+
+    Report level columns are taken from the first row of each report. Every
+    column of flatten_columns is pivoted to <column>_0, <column>_1, ... in the
+    row order of df, with NaN for reports that have fewer rows.
+    """
+    grouped = df.groupby('report_id')
+    final_data = grouped[report_columns].first()
+
+    position = grouped.cumcount()
+    pivoted = df[flatten_columns].set_index([df['report_id'], position]).unstack()
+    # unstack of the whole frame gives (column, position) pairs, name them
+    # <column>_<position> in the same order as one pivot per column
+    pivoted = pivoted[flatten_columns]
+    pivoted.columns = [f'{col}_{pos}' for col, pos in pivoted.columns]
+
+    final_data = pd.concat([final_data, pivoted], axis=1)
+    return final_data.reset_index(drop=True)
@@ -0,0 +1,265 @@
+import hashlib
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.metrics import f1_score
+from sklearn.model_selection import ParameterSampler, StratifiedKFold
+from xgboost import XGBClassifier
+
+# training data of a pool worker, set once by _init_worker instead of being
+# pickled with every fold
+_worker_X = None
+_worker_y = None
+
+def _init_worker(X, y):
+    global _worker_X, _worker_y
+    _worker_X = X
+    _worker_y = y
+
+def _take(X, idx):
+    return X.iloc[idx] if isinstance(X, (pd.DataFrame, pd.Series)) else X[idx]
+
+def _fit_fold(params, train_idx, test_idx):
+    """Fits one candidate on one CV fold and returns its F1 score."""
+    xgbc = XGBClassifier(**params)
+    xgbc.fit(_take(_worker_X, train_idx), _take(_worker_y, train_idx))
+    predictions = xgbc.predict(_take(_worker_X, test_idx))
+    return f1_score(_take(_worker_y, test_idx), predictions, pos_label=1)
+
+
+class hyperparameter_search():
+    """Parallel, budgeted hyperparameter search for the bias crime XGBoost model.
+
+    Candidates are sampled from param_grid and pruned with successive halving:
+    every candidate is first scored with cv-fold F1 on a small stratified
+    subsample of the training rows, only the best 1/factor of them move on
+    to the next rung, which uses factor times more rows, until the last rung
+    scores the remaining candidates on all rows. The folds of all candidates
+    in a rung are fit in parallel in a process pool.
+
+    Every finished trial (candidate, rung) is appended to checkpoint_path, so
+    a search that is interrupted (or stopped by time_budget) resumes from the
+    trials already done instead of starting over. The first line of the
+    checkpoint holds a fingerprint of X, y and the search config; a checkpoint
+    of other data or another config is not resumed from but started over.
+
+    key variables:
+    self.cv_results_: dataframe with one row per trial
+    self.best_params_: sampled params of the best candidate of the last rung
+    self.best_estimator_: XGBClassifier refit on all rows with best_params_
+
+    Usage:
+    search = hyperparameter_search(param_grid, estimator_params=default_params_xgb,
+                                   n_candidates=60, checkpoint_path='search_trials.jsonl')
+    search.fit(X_train, y_train)
+    bp = search.best_params_
+    """
+    def __init__(self, param_grid, estimator_params=None, n_candidates=30, cv=3, factor=3,
+                 min_samples=None, n_jobs=None, checkpoint_path=None, time_budget=None,
+                 refit=True, random_state=0):
+        """
+        param_grid: dict of hyperparameter -> list of values to sample from
+        estimator_params: fixed XGBClassifier params, sampled params override them
+        n_candidates: number of candidates sampled for the first rung
+        cv: number of stratified CV folds
+        factor: share of candidates kept (1/factor) and growth of the rows per rung
+        min_samples: rows of the first rung, defaults to the rows needed to end
+                     on all rows after the halving rungs
+        n_jobs: processes fitting folds in parallel, defaults to the cpu count
+        checkpoint_path: JSON lines file of finished trials, None disables it
+        time_budget: seconds after which no new rung is started
+        refit: refit best_params_ on all rows into best_estimator_
+        random_state: seed for candidate sampling, subsamples and folds
+        """
+        self.param_grid = param_grid
+        self.estimator_params = dict(estimator_params or {})
+        self.n_candidates = n_candidates
+        self.cv = cv
+        self.factor = factor
+        self.min_samples = min_samples
+        self.n_jobs = n_jobs or os.cpu_count() or 1
+        self.checkpoint_path = checkpoint_path
+        self.time_budget = time_budget
+        self.refit = refit
+        self.random_state = random_state
+
+    def candidates(self):
+        """Samples the candidate params, the same ones on every run with the
+        same random_state so a resumed search continues the same trials."""
+        n_grid = np.prod([len(values) for values in self.param_grid.values()])
+        n_iter = int(min(self.n_candidates, n_grid))
+        return list(ParameterSampler(self.param_grid, n_iter=n_iter, random_state=self.random_state))
+
+    def rung_sizes(self, n_rows, n_candidates):
+        """Rows used by each rung, growing by factor and ending on n_rows. Rungs
+        that would score on as many rows as the previous one are dropped."""
+        n_rungs = max(int(math.floor(math.log(max(n_candidates, 1), self.factor))) + 1, 1)
+        min_samples = self.min_samples or int(n_rows / self.factor ** (n_rungs - 1))
+        # every fold needs members of both classes
+        min_samples = max(min_samples, 4 * self.cv)
+        sizes = [min(int(min_samples * self.factor ** rung), n_rows) for rung in range(n_rungs - 1)] + [n_rows]
+        return sorted(set(sizes))
+
+    def _subsample(self, y, n_samples):
+        """Stratified, nested subsample: the rows of a rung include the rows of
+        every smaller rung."""
+        y = np.asarray(y)
+        rng = np.random.default_rng(self.random_state)
+        share = n_samples / len(y)
+        idx = []
+        for label in np.unique(y):
+            members = rng.permutation(np.flatnonzero(y == label))
+            idx.append(members[:max(int(math.ceil(share * len(members))), self.cv)])
+        return np.sort(np.concatenate(idx))
+
+    def search_config(self):
+        """Settings that change the trials of a search, part of the checkpoint
+        fingerprint. n_jobs, time_budget and refit do not change them."""
+        return {'param_grid': self.param_grid, 'estimator_params': self.estimator_params,
+                'n_candidates': self.n_candidates, 'cv': self.cv, 'factor': self.factor,
+                'min_samples': self.min_samples, 'scoring': 'f1', 'random_state': self.random_state}
+
+    def fingerprint(self, X, y):
+        """Hashes the rows and columns of X and y and the search config."""
+        digest = hashlib.sha256()
+        for data in (X, y):
+            if isinstance(data, (pd.DataFrame, pd.Series)):
+                if isinstance(data, pd.DataFrame):
+                    schema = [(str(col), str(dtype)) for col, dtype in data.dtypes.items()]
+                    digest.update(json.dumps(schema).encode())
+                digest.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+            elif sp.issparse(data):
+                data = data.tocsr()
+                digest.update(f'{data.shape}{data.dtype}'.encode())
+                for part in (data.data, data.indices, data.indptr):
+                    digest.update(np.ascontiguousarray(part).tobytes())
+            else:
+                data = np.ascontiguousarray(data)
+                digest.update(f'{data.shape}{data.dtype}'.encode())
+                digest.update(data.tobytes())
+        digest.update(json.dumps(self.search_config(), sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def _trial_key(fingerprint, params, rung, n_samples):
+        return f'{fingerprint}|' + json.dumps(params, sort_keys=True, default=str) + f'|{rung}|{n_samples}'
+
+    def _load_checkpoint(self, fingerprint):
+        """Returns the trials of the checkpoint written for fingerprint. A
+        checkpoint without a header or with another fingerprint is replaced by
+        an empty one."""
+        trials = {}
+        if self.checkpoint_path is None:
+            return trials
+        if os.path.isfile(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                lines = [line.strip() for line in f if line.strip()]
+            header = None
+            if lines:
+                try:
+                    header = json.loads(lines[0]).get('header')
+                except ValueError:
+                    pass
+            if header is not None and header.get('fingerprint') == fingerprint:
+                for line in lines[1:]:
+                    try:
+                        trial = json.loads(line)
+                    except ValueError:
+                        # line cut short by an interruption
+                        continue
+                    if trial.get('fingerprint') != fingerprint:
+                        continue
+                    trials[self._trial_key(fingerprint, trial['params'], trial['rung'], trial['n_samples'])] = trial
+                return trials
+            print(f"{self.checkpoint_path} was written for other data or another search config, starting over.")
+        with open(self.checkpoint_path, 'w') as f:
+            header = {'fingerprint': fingerprint, 'config': self.search_config()}
+            f.write(json.dumps({'header': header}, sort_keys=True, default=str) + '\n')
+        return trials
+
+    def _save_trial(self, trial):
+        if self.checkpoint_path is None:
+            return
+        with open(self.checkpoint_path, 'a') as f:
+            f.write(json.dumps(trial, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _run_rung(self, executor, y, candidates, rung, n_samples, done, fingerprint):
+        """Scores every candidate on n_samples rows and returns their trials."""
+        rows = self._subsample(y, n_samples)
+        folds = list(StratifiedKFold(n_splits=self.cv, shuffle=True, random_state=self.random_state)
+                     .split(np.zeros(len(rows)), np.asarray(y)[rows]))
+        trials = {}
+        futures = {}
+        for params in candidates:
+            key = self._trial_key(fingerprint, params, rung, n_samples)
+            if key in done:
+                # keep the sampled values, the checkpoint holds their json form
+                trials[key] = dict(done[key], params=params)
+                continue
+            # one thread per fit, the parallelism is across folds and candidates
+            fold_params = {**self.estimator_params, **params, 'n_jobs': 1}
+            for fold, (train_idx, test_idx) in enumerate(folds):
+                future = executor.submit(_fit_fold, fold_params, rows[train_idx], rows[test_idx])
+                futures[future] = (key, params, fold)
+
+        fold_scores = {}
+        for future in as_completed(futures):
+            key, params, fold = futures[future]
+            fold_scores.setdefault(key, {})[fold] = future.result()
+            if len(fold_scores[key]) == self.cv:
+                scores = [fold_scores[key][i] for i in range(self.cv)]
+                trial = {'fingerprint': fingerprint, 'params': params, 'rung': rung, 'n_samples': int(n_samples),
+                         'fold_scores': scores, 'mean_score': float(np.mean(scores)),
+                         'std_score': float(np.std(scores))}
+                self._save_trial(trial)
+                trials[key] = trial
+        return [trials[self._trial_key(fingerprint, params, rung, n_samples)] for params in candidates]
+
+    def fit(self, X, y):
+        """Runs the search on X, y and refits the best candidate."""
+        start = time.time()
+        fingerprint = self.fingerprint(X, y)
+        done = self._load_checkpoint(fingerprint)
+        candidates = self.candidates()
+        sizes = self.rung_sizes(len(y), len(candidates))
+        results = []
+        self.stopped_early = False
+
+        with ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_worker,
+                                 initargs=(X, y)) as executor:
+            for rung, n_samples in enumerate(sizes):
+                if self.time_budget is not None and rung > 0 and time.time() - start > self.time_budget:
+                    print(f"Time budget of {self.time_budget}s used up, stopping before rung {rung}.")
+                    self.stopped_early = True
+                    break
+                trials = self._run_rung(executor, y, candidates, rung, n_samples, done, fingerprint)
+                results += trials
+                if rung < len(sizes) - 1:
+                    n_keep = max(int(math.ceil(len(candidates) / self.factor)), 1)
+                    order = np.argsort([-trial['mean_score'] for trial in trials], kind='mergesort')
+                    candidates = [candidates[i] for i in order[:n_keep]]
+
+        self.cv_results_ = pd.DataFrame(results)
+        last_rung = self.cv_results_[self.cv_results_['rung'] == self.cv_results_['rung'].max()]
+        best = last_rung.loc[last_rung['mean_score'].idxmax()]
+        self.best_params_ = best['params']
+        self.best_score_ = best['mean_score']
+        self.search_seconds = time.time() - start
+        if self.refit:
+            self.best_estimator_ = XGBClassifier(**{**self.estimator_params, **self.best_params_})
+            self.best_estimator_.fit(X, y)
+        return self
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)
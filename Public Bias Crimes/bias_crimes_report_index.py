@@ -0,0 +1,174 @@
+import os
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+
+from bias_crimes_storage import applySchema
+
+
+class report_index():
+    """Persisted index of the reports processed by the daily inference job.
+
+    Replaces reading the whole final_reports.csv output to find the latest
+    report_submitted_date and the reporting_event_numbers already processed.
+    The index is a small SQLite file with one row per reporting_event_number
+    (the latest report_submitted_date it was processed with) and the
+    report_submitted_date high-water mark of all runs.
+
+    Only the candidate reports of a run are looked up, so the cost of a daily
+    run depends on the number of new reports, not on the size of the history.
+
+    Usage:
+    index = report_index("report_index.sqlite")
+    filtered_demo = index.filterNew(demographics)
+    ...
+    index.markProcessed(df)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS processed_reports (
+                                     reporting_event_number INTEGER PRIMARY KEY,
+                                     report_id INTEGER,
+                                     report_submitted_date TEXT,
+                                     processed_at TEXT)""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS meta (
+                                     key TEXT PRIMARY KEY,
+                                     value TEXT)""")
+
+    def close(self):
+        self.conn.close()
+
+    def highWaterMark(self):
+        """Latest report_submitted_date processed so far, or None on the first run."""
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'high_water_mark'").fetchone()
+        return pd.Timestamp(row[0]) if row else None
+
+    def processedCount(self):
+        return self.conn.execute("SELECT COUNT(*) FROM processed_reports").fetchone()[0]
+
+    def processedDates(self, reporting_event_numbers):
+        """Returns the report_submitted_date each of the given
+        reporting_event_numbers was processed with, indexed by
+        reporting_event_number. Unprocessed reports are left out."""
+        rens = [(int(ren),) for ren in pd.unique(pd.Series(reporting_event_numbers).dropna())]
+        with self.conn:
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS candidates (reporting_event_number INTEGER PRIMARY KEY)")
+            self.conn.execute("DELETE FROM candidates")
+            self.conn.executemany("INSERT OR IGNORE INTO candidates VALUES (?)", rens)
+            rows = self.conn.execute("""SELECT p.reporting_event_number, p.report_submitted_date
+                                        FROM processed_reports p
+                                        JOIN candidates c USING (reporting_event_number)""").fetchall()
+        processed = pd.Series({ren: date for ren, date in rows}, dtype=object)
+        return pd.to_datetime(processed)
+
+    def filterNew(self, df, date_col='report_submitted_date', id_col='reporting_event_number'):
+        """Keeps the rows of df that still need processing.
+
+        Like the previous final_reports.csv check, only reports submitted at the
+        high-water mark date or later are considered (in case some reports with
+        the last date were not processed). Of those, reports that were never
+        processed are kept, and so are reports submitted again after the date
+        they were processed with (changed reports).
+        """
+        high_water_mark = self.highWaterMark()
+        if high_water_mark is not None:
+            df = df[df[date_col] >= high_water_mark]
+        processed = self.processedDates(df[id_col])
+        last_processed = df[id_col].map(processed)
+        return df[last_processed.isna() | (df[date_col] > last_processed)]
+
+    def markProcessed(self, df, date_col='report_submitted_date', id_col='reporting_event_number'):
+        """Records the reports of df as processed and moves the high-water mark
+        forward to their latest report_submitted_date."""
+        if df.empty:
+            return
+        dates = pd.to_datetime(df[date_col])
+        latest = dates.groupby(df[id_col]).max()
+        report_ids = df.groupby(id_col)['report_id'].first() if 'report_id' in df.columns else {}
+        processed_at = datetime.now().isoformat()
+        rows = [(int(ren), None if pd.isna(report_ids.get(ren)) else int(report_ids.get(ren)),
+                 date.isoformat(), processed_at)
+                for ren, date in latest.items() if pd.notna(date)]
+        high_water_mark = self.highWaterMark()
+        new_mark = latest.max()
+        if high_water_mark is not None and high_water_mark > new_mark:
+            new_mark = high_water_mark
+        with self.conn:
+            self.conn.executemany("""INSERT INTO processed_reports VALUES (?, ?, ?, ?)
+                                     ON CONFLICT(reporting_event_number) DO UPDATE SET
+                                         report_id = excluded.report_id,
+                                         report_submitted_date = MAX(report_submitted_date, excluded.report_submitted_date),
+                                         processed_at = excluded.processed_at""", rows)
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('high_water_mark', ?)", (new_mark.isoformat(),))
+
+
+def appendPartitions(df, partition_dir, date_col='report_submitted_date', schema=None):
+    """Appends the rows of a source extract (e.g. incident_offense.csv) to a
+    Parquet dataset partitioned by day of date_col:
+    partition_dir/<date_col>_day=YYYY-MM-DD/part-<timestamp>-<n>.parquet
+
+    With a schema (e.g. bias_crimes_storage.incident_offense_schema) every
+    part is written with the same column types, whatever pandas inferred
+    for the extract.
+
+    Returns the list of files written.
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError("pyarrow is required to write parquet partitions, please install it.")
+    df = applySchema(df, schema)
+    dates = pd.to_datetime(df[date_col])
+    days = dates.dt.strftime('%Y-%m-%d')
+    batch = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    written = []
+    for n, (day, part) in enumerate(df.assign(**{date_col: dates}).groupby(days)):
+        day_dir = os.path.join(partition_dir, f'{date_col}_day={day}')
+        os.makedirs(day_dir, exist_ok=True)
+        path = os.path.join(day_dir, f'part-{batch}-{n:05d}.parquet')
+        part.to_parquet(path, index=False)
+        written.append(path)
+    return written
+
+def partitionExtract(csv_path, partition_dir, date_col='report_submitted_date', chunksize=100000,
+                     schema=None):
+    """Converts a full csv extract to a day-partitioned Parquet dataset, reading
+    it chunksize rows at a time. Returns the number of rows written."""
+    n_rows = 0
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+        appendPartitions(chunk, partition_dir, date_col, schema)
+        n_rows += len(chunk)
+    return n_rows
+
+def readPartitions(partition_dir, since=None, columns=None, date_col='report_submitted_date',
+                   schema=None):
+    """Reads the day partitions written by appendPartitions, skipping every
+    partition before the day of since (e.g. the report_index high-water mark).
+
+    Args:
+        partition_dir (str): root of the partitioned dataset
+        since (datetime): only read days on or after this date, None reads all
+        columns (list): columns to read, None reads all
+        schema (dict): column types of the result, see bias_crimes_storage
+
+    Returns:
+        dataframe of the selected partitions
+    """
+    prefix = f'{date_col}_day='
+    since_day = pd.Timestamp(since).strftime('%Y-%m-%d') if since is not None else None
+    parts = []
+    for name in sorted(os.listdir(partition_dir)):
+        if not name.startswith(prefix):
+            continue
+        if since_day is not None and name[len(prefix):] < since_day:
+            continue
+        day_dir = os.path.join(partition_dir, name)
+        for file_name in sorted(os.listdir(day_dir)):
+            if file_name.endswith('.parquet'):
+                parts.append(pd.read_parquet(os.path.join(day_dir, file_name), columns=columns))
+    if not parts:
+        return applySchema(pd.DataFrame(columns=columns), schema)
+    return applySchema(pd.concat(parts, ignore_index=True), schema)
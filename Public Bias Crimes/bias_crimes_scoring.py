@@ -0,0 +1,146 @@
+import os
+from itertools import zip_longest
+
+import joblib
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+# report level features after the count vectorizer words, in the order of
+# inference_features.csv
+report_feature_names = ['victim_age_1','subject_age_1','East', 'North', 'precinct_OOJ', 'South', 'Southwest', 'West', 'precinct_Unknown',
+                        'Female','Gender Diverse (gender non-conforming and/or transgender)', 'Male', 'Vic_Gender_Unknown',
+                        'American Indian or Alaska Native', 'Asian', 'Black or African American', 'Native Hawaiian or Other Pacific Islander',
+                        'Vic_Race_Unknown', 'White', 'Hispanic Or Latino', 'Not Hispanic Or Latino', 'Vic_Ethni_Unknown',
+                        'subject_American Indian or Alaska Native', 'subject_Asian', 'subject_Black or African American',
+                        'subject_Native Hawaiian or Other Pacific Islander', 'subject_Sub_Race_Unknown', 'subject_White',
+                        'subject_Female', 'subject_Gender Diverse (gender non-conforming and/or transgender)',
+                        'subject_Male', 'subject_Sub_Gender_Unknown', 'subject_Hispanic Or Latino', 'subject_Not Hispanic Or Latino',
+                        'subject_Sub_Ethni_Unknown', 'B1', 'B2', 'B3', 'C1', 'C2', 'C3', 'D1', 'D2', 'D3', 'E1', 'E2', 'E3', 'F1', 'F2',
+                        'F3', 'G1', 'G2', 'G3', 'H1', 'H2', 'H3', 'J1', 'J2', 'J3', 'K1', 'K2', 'K3', 'L1', 'L2', 'L3', 'M1', 'M2', 'M3',
+                        'N1', 'N2', 'N3', 'O1', 'O2', 'O3', 'Q1', 'Q2', 'Q3', 'R1', 'R2', 'R3', 'S1', 'S2', 'S3', 'U1', 'U2', 'U3',
+                        'beat_Unknown', 'W1', 'W2', 'W3', 'beat_OOJ']
+
+
+class bias_crime_scorer():
+    """Long-lived scoring component for the daily bias crime predictions.
+
+    Loads the trained booster, the count vectorizer vocabulary (for the
+    feature names the booster was trained with) and the optimal classification
+    threshold once. Feature rows are scored in fixed-size batches read from a
+    chunked csv reader, thresholded with one vectorized comparison and the
+    positive reports are appended to the output file batch by batch, so
+    memory stays bounded by batch_size whatever the size of the input file.
+
+    The artifacts are reloaded only when their files change on disk, so a
+    process (or notebook kernel) that scores several times a day pays the load
+    cost once. getScorer() keeps one scorer per set of artifact paths.
+
+    Usage:
+    scorer = getScorer()
+    scorer.scoreFile('inference_features.csv', 'inference_reports.csv', 'pos_preds.csv')
+    """
+    def __init__(self, model_path='xgboost_model', vectorizer_path='countvectorizer.pkl',
+                 threshold_path='optimal_threshold.csv', batch_size=10000):
+        self.model_path = model_path
+        self.vectorizer_path = vectorizer_path
+        self.threshold_path = threshold_path
+        self.batch_size = batch_size
+        self._mtimes = None
+        self.load()
+
+    def _artifact_mtimes(self):
+        return tuple(os.path.getmtime(path) for path in
+                     (self.model_path, self.vectorizer_path, self.threshold_path))
+
+    def load(self):
+        """Loads the booster, feature names and threshold from disk."""
+        self.bst = xgb.Booster()
+        self.bst.load_model(self.model_path)
+        cv = joblib.load(self.vectorizer_path)
+        words = cv.get_feature_names_out()
+        self.feature_names = [str(name) for name in np.concatenate((words, report_feature_names))]
+        self.threshold = float(np.loadtxt(self.threshold_path).reshape(-1)[0])
+        self._mtimes = self._artifact_mtimes()
+
+    def reloadIfChanged(self):
+        """Reloads the artifacts if any of them was rewritten (e.g. by the
+        monthly retraining). Returns True if they were reloaded."""
+        if self._artifact_mtimes() != self._mtimes:
+            self.load()
+            return True
+        return False
+
+    def predictBatch(self, features):
+        """Returns the probability of label 1 for a batch of feature rows
+        (numpy array or dataframe in inference_features.csv column order)."""
+        features = np.asarray(features, dtype=np.float32)
+        dfeat = xgb.DMatrix(features, feature_names=self.feature_names)
+        return self.bst.predict(dfeat)
+
+    def classifyBatch(self, features):
+        """Returns (probabilities, 0/1 predictions at the optimal threshold)."""
+        preds = self.predictBatch(features)
+        return preds, (preds >= self.threshold).astype(int)
+
+    def scoreFile(self, features_path='inference_features.csv', reports_path='inference_reports.csv',
+                  output_path='pos_preds.csv', mode='w'):
+        """Scores every row of features_path and writes the report_id and
+        reporting_event_number of the positive predictions to output_path.
+
+        features_path has no header or index (as written by the inference
+        feature engineering) and reports_path holds the ids of the same rows
+        in the same order. A ValueError is raised if the two files do not
+        have the same number of rows.
+
+        Args:
+            mode (str): 'w' starts a new output file (as the notebook did),
+                        'a' appends to an existing one
+
+        Returns:
+            dict with the number of rows scored and of positive predictions
+        """
+        self.reloadIfChanged()
+        header = mode == 'w' or not os.path.isfile(output_path)
+        file_mode = mode
+        n_scored = 0
+        n_positive = 0
+
+        if os.path.getsize(features_path) > 0:
+            features = pd.read_csv(features_path, header=None, dtype=np.float32, chunksize=self.batch_size)
+            reports = pd.read_csv(reports_path, usecols=['report_id', 'reporting_event_number'],
+                                  chunksize=self.batch_size)
+            for feature_batch, report_batch in zip_longest(features, reports):
+                # a file with whole batches more than the other ends the other reader first
+                if feature_batch is None or report_batch is None or len(feature_batch) != len(report_batch):
+                    raise ValueError(f"{features_path} and {reports_path} do not have the same rows.")
+                _, preds_optimal = self.classifyBatch(feature_batch.to_numpy())
+                pos_preds = report_batch[preds_optimal == 1]
+                pos_preds[['report_id', 'reporting_event_number']].to_csv(
+                    output_path, mode=file_mode, header=header, index=False)
+                header = False
+                file_mode = 'a'
+                n_scored += len(feature_batch)
+                n_positive += len(pos_preds)
+        elif len(pd.read_csv(reports_path, usecols=['report_id'], nrows=1)):
+            raise ValueError(f"{features_path} is empty but {reports_path} has rows.")
+
+        if header:
+            # nothing was scored, still leave the (empty) output file behind
+            pd.DataFrame(columns=['report_id', 'reporting_event_number']).to_csv(
+                output_path, mode=file_mode, index=False)
+        return {'scored': n_scored, 'positive': n_positive}
+
+
+_scorers = {}
+
+def getScorer(model_path='xgboost_model', vectorizer_path='countvectorizer.pkl',
+              threshold_path='optimal_threshold.csv', batch_size=10000):
+    """Returns the scorer for these artifacts, creating it on first use."""
+    key = (os.path.abspath(model_path), os.path.abspath(vectorizer_path),
+           os.path.abspath(threshold_path))
+    if key not in _scorers:
+        _scorers[key] = bias_crime_scorer(model_path, vectorizer_path, threshold_path, batch_size)
+    scorer = _scorers[key]
+    scorer.batch_size = batch_size
+    return scorer
@@ -0,0 +1,127 @@
+import os
+
+import pandas as pd
+
+# Column kinds of a schema:
+# str: str values, missing values stay missing. Parquet dictionary encodes
+#      repeated strings on disk, they are kept as str in memory because the
+#      feature engineering fills and pivots them.
+# category: pandas categorical
+# datetime: datetime64
+# int64: int64, float64 when the column has missing values
+# float64: float64
+# Columns not in the schema keep the dtype they have.
+
+# incident_offense extract, read by the inference and training feature engineering
+incident_offense_schema = {
+    'report_id': 'int64',
+    'reporting_event_number': 'int64',
+    'subject_ethnicity': 'str',
+    'subject_gender': 'str',
+    'subject_personid': 'float64',
+    'offense_id': 'int64',
+    'offense_code_id': 'int64',
+    'subject_race': 'str',
+    'subject_age': 'float64',
+    'victim_age': 'float64',
+    'victim_ethnicity': 'str',
+    'victim_gender': 'str',
+    'victim_personid': 'float64',
+    'victim_race': 'str',
+    'beat': 'str',
+    'sector': 'str',
+    'crime_description': 'str',
+    'precinct': 'str',
+    'event_start_date': 'datetime',
+    'approval_status': 'str',
+    'report_submitted_date': 'datetime',
+    # compared with '9601', ids of some extracts read back as numbers
+    'report_ucr_approved_by': 'str',
+}
+
+# final_reports written by the inference feature engineering, the flattened
+# <column>_<n> and one-hot columns keep the types they were built with
+final_reports_schema = {
+    'reporting_event_number': 'int64',
+    'report_id': 'int64',
+    'precinct': 'str',
+    'beat': 'str',
+    'sector': 'str',
+    'event_start_date': 'datetime',
+    'report_submitted_date': 'datetime',
+    'approval_status': 'str',
+    'report_ucr_approved_by': 'str',
+    'narrative': 'str',
+    'corpus': 'str',
+}
+
+
+def _requirePyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError("pyarrow is required to read and write parquet tables, please install it.")
+
+def _values(series):
+    return series.astype(object) if isinstance(series.dtype, pd.CategoricalDtype) else series
+
+def applySchema(df, schema):
+    """Casts the columns of df that are in schema to their kind (see above).
+    Columns missing from df are skipped. Returns a new dataframe."""
+    df = df.copy()
+    for col, kind in (schema or {}).items():
+        if col not in df.columns:
+            continue
+        if kind == 'str':
+            values = _values(df[col])
+            # ids read as floats (missing values in the column) lose their .0
+            if pd.api.types.is_float_dtype(values.dtype) and (values.dropna() % 1 == 0).all():
+                values = values.astype('Int64')
+            df[col] = values.astype(object).where(values.isna(), values.astype(str))
+        elif kind == 'category':
+            df[col] = df[col].astype('category')
+        elif kind == 'datetime':
+            df[col] = pd.to_datetime(df[col])
+        elif kind == 'int64':
+            values = pd.to_numeric(_values(df[col]))
+            df[col] = values.astype('float64' if values.isna().any() else 'int64')
+        elif kind == 'float64':
+            df[col] = pd.to_numeric(_values(df[col])).astype('float64')
+        else:
+            raise ValueError(f"unknown column kind {kind} for column {col}")
+    return df
+
+def writeTable(df, path, schema=None):
+    """Writes df to the Parquet file path with the column types of schema,
+    without the index. Returns path."""
+    _requirePyarrow()
+    applySchema(df, schema).reset_index(drop=True).to_parquet(path, index=False)
+    return path
+
+def readTable(path, schema=None, columns=None, filters=None):
+    """Reads a Parquet file or dataset folder, only reading the requested
+    columns from disk, and applies schema.
+
+    Args:
+        path (str): .parquet file or dataset folder
+        schema (dict): column kinds, see applySchema
+        columns (list): columns to read, None reads all
+        filters (list): pyarrow filters, e.g. [('precinct', '=', 'NORTH')]
+
+    Returns:
+        dataframe
+    """
+    _requirePyarrow()
+    return applySchema(pd.read_parquet(path, columns=columns, filters=filters), schema)
+
+def readTableOrCsv(path, csv_path, schema=None, columns=None):
+    """Reads the Parquet table at path, or csv_path written by earlier runs
+    when path does not exist. Both come back with the types of schema.
+
+    Usage:
+    fe_last = readTableOrCsv('final_reports.parquet', 'final_reports.csv', final_reports_schema,
+                             columns=['reporting_event_number', 'report_id', 'report_submitted_date'])
+    """
+    if os.path.exists(path):
+        return readTable(path, schema, columns=columns)
+    return applySchema(pd.read_csv(csv_path, usecols=columns), schema)
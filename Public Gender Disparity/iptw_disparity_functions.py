@@ -0,0 +1,306 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import fmin_bfgs
+from scipy.stats import norm
+
+# Propensity model, weighting estimator and trimming follow causalinference's
+# CausalModel (est_propensity, est_via_weighting, trim_s), so estimates match
+# the ones of IPTW_Disparity_Code_Github.ipynb.
+
+
+def _sigmoid(x, top_threshold=100, bottom_threshold=-100):
+    values = np.empty(x.shape[0])
+    high_x = x >= top_threshold
+    low_x = x <= bottom_threshold
+    mid_x = ~(high_x | low_x)
+    values[high_x] = 1.0
+    values[low_x] = 0.0
+    values[mid_x] = 1/(1+np.exp(-x[mid_x]))
+    return values
+
+def _log1exp(x, top_threshold=100, bottom_threshold=-100):
+    values = np.empty(x.shape[0])
+    high_x = x >= top_threshold
+    low_x = x <= bottom_threshold
+    mid_x = ~(high_x | low_x)
+    values[high_x] = 0.0
+    values[low_x] = -x[low_x]
+    values[mid_x] = np.log(1 + np.exp(-x[mid_x]))
+    return values
+
+def fit_propensity(X, D):
+    """Fits the logistic propensity model P(D=1|X) with an intercept and every
+    column of X included linearly.
+
+    Returns:
+        (coefficients, fitted propensity scores)
+    """
+    Z = np.empty((X.shape[0], X.shape[1]+1))
+    Z[:, 0] = 1  # constant term
+    Z[:, 1:] = X
+    Z_c, Z_t = Z[D == 0], Z[D == 1]
+    neg_ll = lambda b: _log1exp(Z_t.dot(b)).sum() + _log1exp(-Z_c.dot(b)).sum()
+    neg_grad = lambda b: (_sigmoid(Z_c.dot(b))*Z_c.T).sum(1) - (_sigmoid(-Z_t.dot(b))*Z_t.T).sum(1)
+    coef = fmin_bfgs(neg_ll, np.zeros(Z.shape[1]), neg_grad, full_output=True, disp=False)[0]
+    return coef, _sigmoid(Z.dot(coef))
+
+def select_cutoff(pscore):
+    """Optimal trimming cutoff of Crump, Hotz, Imbens & Mitnik (2009), as
+    computed by CausalModel.trim_s(). Returns 0 when no trimming is needed."""
+    g = 1.0/(pscore*(1-pscore))
+    if g.max() <= 2*g.mean():
+        return 0
+    sorted_g = np.sort(g)
+    # sum of 1 and of g over every value of g up to and including g itself
+    position = np.searchsorted(sorted_g, g, side='right') - 1
+    count_le = position + 1
+    sum_le = np.cumsum(sorted_g)[position]
+    gamma = np.max(g[g * count_le <= 2 * sum_le])
+    return 0.5 - np.sqrt(0.25 - 1./gamma)
+
+def weighted_estimates(Y, D, X, pscore):
+    """Weighting estimator of CausalModel.est_via_weighting() for several
+    outcomes at once.
+
+    The weighted least squares fit of every outcome on [1, D, X] shares the
+    same design matrix, so all outcomes are solved with one lstsq call and
+    their robust standard errors with one matrix product.
+
+    Args:
+        Y (array): N x M matrix, one column per outcome
+        D (array): treatment indicator
+        X (array): N x K covariates
+        pscore (array): propensity scores
+
+    Returns:
+        (ate, ate_se) arrays with one value per outcome
+    """
+    weights = np.where(D == 1, 1/pscore, 1/(1-pscore))
+    Y_w = weights[:, None] * Y
+    Z_w = np.empty((X.shape[0], X.shape[1]+2))
+    Z_w[:, 0] = weights
+    Z_w[:, 1] = weights * D
+    Z_w[:, 2:] = weights[:, None] * X
+
+    wlscoef = np.linalg.lstsq(Z_w, Y_w, rcond=None)[0]
+    u_w = Y_w - Z_w.dot(wlscoef)
+    try:
+        A = np.linalg.inv(np.dot(Z_w.T, Z_w))
+    except np.linalg.LinAlgError:
+        # collinear covariates, e.g. an indicator that is constant within a
+        # sub-population; the treatment coefficient is still identified
+        A = np.linalg.pinv(np.dot(Z_w.T, Z_w))
+    # diagonal element of the sandwich covariance for the treatment coefficient
+    ZA_1 = np.dot(Z_w, A[:, 1])
+    ate_se = np.sqrt(((u_w * ZA_1[:, None])**2).sum(0))
+    return wlscoef[1], ate_se
+
+# data of a bootstrap pool worker, set once by _init_worker instead of being
+# pickled with every replicate
+_worker_df = None
+
+def _init_worker(df):
+    global _worker_df
+    _worker_df = df
+
+def _bootstrap_replicate(treatment, specs, trim, by, values, seed):
+    """Refits every propensity model of specs on one bootstrap sample, drawn
+    with replacement within the treated and control rows of each group, and
+    returns the ates in the row order of iptw_engine.run()."""
+    rng = np.random.default_rng(seed)
+    ates = []
+    for value in values:
+        df = _worker_df if by is None else _worker_df[_worker_df[by] == value]
+        D = df[treatment].to_numpy()
+        rows = np.sort(np.concatenate([rng.choice(np.flatnonzero(D == d), size=int((D == d).sum()))
+                                       for d in (0, 1)]))
+        engine = iptw_engine(df.iloc[rows], treatment)
+        for outcomes, covariates in specs:
+            ates.extend(engine.model(covariates).estimate(outcomes, trim)['ate'])
+    return ates
+
+
+class iptw_model():
+    """Propensity model of one treatment on one covariate set.
+
+    The propensity model is fit once and the trimmed samples are cached per
+    cutoff, so any number of outcomes can be estimated against it without
+    refitting.
+
+    key variables:
+    self.coef: logistic regression coefficients (intercept first)
+    self.pscore: fitted propensity scores
+    self.cutoff: cutoff selected by trim_s (Crump et al.)
+
+    Usage:
+    model = iptw_model(ci_temp, 'gender_binary', covariates)
+    model.estimate(['Complaints Count', 'Promotion Count'], trim='crump')
+    """
+    def __init__(self, df, treatment, covariates):
+        self.treatment = treatment
+        self.covariates = list(covariates)
+        self.df = df
+        self.D = df[treatment].to_numpy()
+        self.X = df[self.covariates].to_numpy(dtype=float)
+        self.coef, self.pscore = fit_propensity(self.X, self.D)
+        self.cutoff = select_cutoff(self.pscore)
+        self._trim_masks = {}
+
+    def trim_mask(self, trim='crump'):
+        """Rows kept after trimming. trim is 'crump' for the trim_s cutoff, a
+        float cutoff (as CausalModel.trim with that cutoff) or None."""
+        cutoff = self.cutoff if trim == 'crump' else (trim or 0)
+        if cutoff not in self._trim_masks:
+            if 0 < cutoff <= 0.5:
+                mask = (self.pscore >= cutoff) & (self.pscore <= 1-cutoff)
+            elif cutoff == 0:
+                mask = np.ones(len(self.pscore), dtype=bool)
+            else:
+                raise ValueError('Invalid cutoff.')
+            self._trim_masks[cutoff] = mask
+        return self._trim_masks[cutoff]
+
+    def estimate(self, outcomes, trim=None):
+        """Weighted ATE of the treatment on each outcome column.
+
+        Args:
+            outcomes (list): outcome columns; none of them may be a covariate
+            trim: None (no trimming), 'crump' or a float cutoff, see trim_mask()
+
+        Returns:
+            dataframe with one row per outcome: ate, ate_se, z, p_value,
+            ci_lower, ci_upper, the cutoff and the number of rows used
+        """
+        outcomes = list(outcomes)
+        overlap = set(outcomes) & set(self.covariates)
+        if overlap:
+            raise ValueError(f"Outcomes {sorted(overlap)} are also covariates of this model.")
+        keep = self.trim_mask(trim)
+        Y = self.df[outcomes].to_numpy(dtype=float)[keep]
+        ate, ate_se = weighted_estimates(Y, self.D[keep], self.X[keep], self.pscore[keep])
+        z = ate / ate_se
+        return pd.DataFrame({
+            'outcome': outcomes,
+            'ate': ate,
+            'ate_se': ate_se,
+            'z': z,
+            'p_value': 2*(1 - norm.cdf(np.abs(z))),
+            'ci_lower': ate - 1.96*ate_se,
+            'ci_upper': ate + 1.96*ate_se,
+            'cutoff': self.cutoff if trim == 'crump' else (trim or 0),
+            'n': int(keep.sum()),
+            'n_treated': int((self.D[keep] == 1).sum()),
+            'n_control': int((self.D[keep] == 0).sum()),
+        })
+
+
+class iptw_engine():
+    """Runs IPTW estimates for many outcomes, covariate sets and
+    sub-populations, fitting each propensity model only once.
+
+    Models are cached by (covariate set, sub-population), so outcomes that
+    share a covariate set are estimated in one batched pass and repeated
+    calls reuse the fitted models and their trimming.
+
+    Usage:
+    engine = iptw_engine(ci_temp, 'gender_binary')
+    results = engine.run([(['Complaints Count'], covariates_c),
+                          (['Dollars Earned (Gross)'], covariates_d)],
+                         trim='crump', by='Last Pay Year')
+    """
+    def __init__(self, df, treatment):
+        self.df = df
+        self.treatment = treatment
+        self._models = {}
+
+    def model(self, covariates, by=None, value=None):
+        """Returns the (cached) model for a covariate set, fit on all rows or,
+        with by, on the rows where column by equals value."""
+        key = (tuple(covariates), by, value)
+        if key not in self._models:
+            df = self.df if by is None else self.df[self.df[by] == value]
+            self._models[key] = iptw_model(df, self.treatment, covariates)
+        return self._models[key]
+
+    def run(self, specs, trim=None, by=None):
+        """Estimates every (outcomes, covariates) pair of specs.
+
+        Args:
+            specs (list): (list of outcome columns, list of covariates) pairs
+            trim: passed to iptw_model.estimate
+            by (str): optional column to estimate separately for each of its
+                      values (e.g. 'Last Pay Year')
+
+        Returns:
+            dataframe with one row per outcome (and group)
+        """
+        values = [None] if by is None else sorted(self.df[by].dropna().unique())
+        results = []
+        for value in values:
+            for outcomes, covariates in specs:
+                result = self.model(covariates, by, value).estimate(outcomes, trim)
+                if by is not None:
+                    result.insert(0, by, value)
+                results.append(result)
+        return pd.concat(results, ignore_index=True)
+
+    def bootstrap(self, specs, n_replicates=200, trim=None, by=None, time_limit=None,
+                  n_workers=None, alpha=0.05, random_state=0):
+        """Bootstrap confidence intervals for run().
+
+        The standard errors of run() treat the propensity scores as known.
+        Every bootstrap replicate refits the propensity models (and the
+        trimming cutoff) on a resample of the rows, so the intervals include
+        the propensity model uncertainty. Replicates run in a process pool.
+
+        Args:
+            specs, trim, by: as for run()
+            n_replicates (int): number of bootstrap replicates
+            time_limit (float): seconds after which no new replicate is started
+            n_workers (int): worker processes, defaults to the cpu count
+            alpha (float): the intervals cover 1 - alpha
+            random_state (int): seed; results do not depend on n_workers
+
+        Returns:
+            the run() dataframe with n_replicates, boot_se, boot_ci_lower,
+            boot_ci_upper and boot_p_value (two-sided, share of replicates on
+            the other side of 0)
+        """
+        results = self.run(specs, trim, by)
+        values = [None] if by is None else sorted(self.df[by].dropna().unique())
+        n_workers = n_workers or os.cpu_count() or 1
+        start = time.time()
+        replicates = {}
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(self.df,)) as executor:
+            pending = {}
+            next_replicate = 0
+            while True:
+                while len(pending) < 2 * n_workers and next_replicate < n_replicates:
+                    if time_limit is not None and time.time() - start > time_limit:
+                        print(f"Time limit of {time_limit}s reached after {next_replicate} replicates.")
+                        n_replicates = next_replicate
+                        break
+                    seed = np.random.SeedSequence([random_state, next_replicate])
+                    future = executor.submit(_bootstrap_replicate, self.treatment, specs, trim, by, values, seed)
+                    pending[future] = next_replicate
+                    next_replicate += 1
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    replicates[pending.pop(future)] = future.result()
+
+        ates = np.array([replicates[r] for r in sorted(replicates)], dtype=float).reshape(-1, len(results))
+        results['n_replicates'] = len(ates)
+        results['boot_se'] = ates.std(axis=0, ddof=1) if len(ates) > 1 else np.nan
+        lower, upper = np.quantile(ates, [alpha/2, 1 - alpha/2], axis=0) if len(ates) else (np.nan, np.nan)
+        results['boot_ci_lower'] = lower
+        results['boot_ci_upper'] = upper
+        results['boot_p_value'] = np.minimum(1.0, 2*np.minimum((ates <= 0).mean(axis=0), (ates >= 0).mean(axis=0))) \
+            if len(ates) else np.nan
+        return results
@@ -2,19 +2,86 @@ from sklearn.impute import SimpleImputer
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import OneHotEncoder
 from sklearn.preprocessing import StandardScaler
+from sklearn.preprocessing import FunctionTransformer
 from sklearn.compose import ColumnTransformer
+from sklearn.model_selection import train_test_split
 from sqlalchemy import column
 import pandas as pd
 from datetime import datetime
 import xgboost as xgb
+import numpy as np
+import scipy.sparse as sp
+from public_psm_results import psm_result_collector
+from public_psm_estimation import compute_weights, weighted_difference
+from public_psm_instrumentation import no_stage, psm_instrumentation
+from public_psm_model_cache import previous_cell
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import logging
-import time, os
+import time, os, json
 
 region = "us-gov-west-1"
 
 # set time zone
 os.environ['TZ'] = 'US/Pacific'
 
+
+def _stored_csr(X):
+    """Converts the dense numeric block to a CSR matrix that stores every
+    entry, zeros included. XGBoost treats entries missing from a sparse 
+    matrix as missing values, so a standardized value of exactly 0 (e.g. a
+    mean imputed one) must be stored to stay a 0."""
+    X = np.asarray(X, dtype=np.float64)
+    n_rows, n_cols = X.shape
+    indptr = np.arange(n_rows + 1) * n_cols
+    indices = np.tile(np.arange(n_cols), n_rows)
+    return sp.csr_matrix((X.ravel(), indices, indptr), shape=X.shape)
+
+
+class xgb_training_policy():
+    """Training configuration for the xgb_psm classifier.
+
+    The defaults reproduce the original fixed budget of 3000 rounds at a 
+    learning rate of 0.01 (parameters provided by Greg Ridgeway). 
+
+    key variables:
+    n_estimators: maximum number of boosting rounds
+    learning_rate, max_depth: booster parameters
+    tree_method: XGBoost tree method, e.g. "hist" for the fast histogram
+                 method. None keeps XGBoost's default.
+    early_stopping_rounds: stop when the held-out logloss has not improved 
+                           for this many rounds. None disables early stopping.
+    validation_fraction: share of the cell held out for early stopping.
+    refit: refit on the whole cell with the number of rounds found by early
+           stopping, so every row is used to fit the propensity model.
+    rounds_per_row: scale the round budget with the cell size: 
+                    min(n_estimators, max(min_rounds, rounds_per_row * rows)).
+                    None always uses n_estimators.
+    min_rounds: lower bound for the scaled round budget.
+    random_state: seed for the classifier and the held-out split.
+    """
+    def __init__(self, n_estimators=3000, learning_rate=0.01, max_depth=2,
+                 tree_method=None, early_stopping_rounds=None,
+                 validation_fraction=0.2, refit=True, rounds_per_row=None,
+                 min_rounds=100, random_state=0):
+        self.n_estimators = n_estimators
+        self.learning_rate = learning_rate
+        self.max_depth = max_depth
+        self.tree_method = tree_method
+        self.early_stopping_rounds = early_stopping_rounds
+        self.validation_fraction = validation_fraction
+        self.refit = refit
+        self.rounds_per_row = rounds_per_row
+        self.min_rounds = min_rounds
+        self.random_state = random_state
+
+    def rounds_for(self, n_rows):
+        """Returns the boosting round budget for a cell of n_rows rows."""
+        if self.rounds_per_row is None or n_rows is None:
+            return self.n_estimators
+        return int(min(self.n_estimators,
+                       max(self.min_rounds, self.rounds_per_row * n_rows)))
+
 class xgb_psm():
     """Custom Propensity Scoring Class using XGBoost.
     Authors: Carl Sharpe, Greg Ridgeway, Loren Atherley, Emma Heo
@@ -53,12 +120,40 @@ class xgb_psm():
     - Enable more customization for fitting data to support test/train splits.
 
     """
-    def __init__(self, verbosity=0):
+    def __init__(self, verbosity=0, n_jobs=None, model_cache=None,
+                 warm_start_rounds=300, training_policy=None, sparse=False,
+                 instrumentation=None, warm_start_rebase_months=12):
         """Constructs the class, sets the verbosity (default 0). Uses Pythons'
         native logging capability
         verbosity = 1 <-- Warn
         verbosity = 2 <-- Info
         verbosity = 3 <-- Debug
+
+        n_jobs is the number of threads given to the XGBoost classifier. None
+        lets XGBoost use every available core; set it when several evaluators
+        run side by side so they do not oversubscribe the machine.
+
+        model_cache is an optional psm_model_cache. When set, just_send_it 
+        loads the fitted processor and classifier of a cell whose rows, schema
+        and hyperparameters match a cached entry instead of refitting. 
+        warm_start_rounds is the number of extra boosting rounds used when a 
+        model continues from the base model of its precinct (see fit_or_load).
+        warm_start_rebase_months is the number of months after which a 
+        precinct's chain is refit from scratch as a new base model.
+
+        training_policy is an optional xgb_training_policy (round budget, 
+        early stopping, tree method). Defaults to the original fixed budget.
+
+        sparse=True keeps the one-hot encoded features as a CSR matrix instead
+        of a dense array, which keeps wide officer-level feature sets small. 
+        XGBoost treats entries that are not stored in a sparse matrix as 
+        missing rather than 0, so results can differ slightly from the dense 
+        path.
+
+        instrumentation is an optional psm_instrumentation. When set, 
+        just_send_it records the time, peak memory and shapes of each stage:
+        labeling, pipeline_build, process_X_y, fit, predict and weighting 
+        (and cache_lookup and cache_store with a model cache).
         """
         logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
                             datefmt="%m/%d/%Y %I:%M:%S %p %Z")
@@ -74,8 +169,37 @@ class xgb_psm():
             self.logger.warn("Verbosity set to WARN")
         if verbosity == 0:
             self.logger.setLevel(logging.ERROR)
+        self.n_jobs = n_jobs
+        self.model_cache = model_cache
+        self.warm_start_rounds = warm_start_rounds
+        self.warm_start_rebase_months = warm_start_rebase_months
+        self.cache_hit = False
+        self.warm_started = False
+        if training_policy is None:
+            training_policy = xgb_training_policy()
+        self.training_policy = training_policy
+        self.sparse = sparse
+        self.instrumentation = instrumentation
+        self.rounds_budget = None
+        self.rounds_used = None
+        self.fit_seconds = 0.0
+        self.seconds_saved = 0.0
         self.data = ""
 
+    def _stage(self, name, **info):
+        """Context manager measuring one stage with the instrumentation, if any."""
+        if self.instrumentation is None:
+            return no_stage(name, **info)
+        return self.instrumentation.stage(name, **info)
+
+    def _processed_shape(self):
+        """Shape of X_processed for the stage records."""
+        shape = {"processed_rows": self.X_processed.shape[0],
+                 "processed_columns": self.X_processed.shape[1]}
+        if hasattr(self.X_processed, "nnz"):
+            shape["processed_nnz"] = int(self.X_processed.nnz)
+        return shape
+
     def load_dataframe(self, df):
         """
         loads the dataframe to be evaluated into self.data
@@ -120,16 +244,21 @@ class xgb_psm():
 
     def create_pipeline(self):
         """Creates full processor by interrogating the X dataframe types for numeric and non-numeric
-        datatypes to create categorical and continuous encoders."""
+        datatypes to create categorical and continuous encoders. With self.sparse the processor
+        outputs a CSR matrix: the one-hot block only stores its ones, the numeric block stores
+        every value (see _stored_csr), so only NaN is missing to XGBoost, as in the dense path."""
         if isinstance(self.data, pd.DataFrame):
             self.categorical_pipeline = Pipeline(steps=[
                 ("impute", SimpleImputer(strategy="most_frequent")),
                 ("oh-encode",
-                 OneHotEncoder(handle_unknown="ignore", sparse=False)),
+                 OneHotEncoder(handle_unknown="ignore", sparse=self.sparse)),
             ])
-            self.numeric_pipeline = Pipeline(
-                steps=[("impute", SimpleImputer(
-                    strategy="mean")), ("scale", StandardScaler())])
+            numeric_steps = [("impute", SimpleImputer(strategy="mean")),
+                             ("scale", StandardScaler())]
+            if self.sparse:
+                numeric_steps.append(("store", FunctionTransformer(
+                    _stored_csr, feature_names_out="one-to-one")))
+            self.numeric_pipeline = Pipeline(steps=numeric_steps)
 
             cat_cols = self.X.select_dtypes(exclude="number").columns
             num_cols = self.X.select_dtypes(include="number").columns
@@ -137,32 +266,197 @@ class xgb_psm():
             self.full_processor = ColumnTransformer(transformers=[
                 ("numeric", self.numeric_pipeline, num_cols),
                 ("categorical", self.categorical_pipeline, cat_cols),
-            ])
+            ], sparse_threshold=1.0 if self.sparse else 0)
         else:
             print(
                 "Object does not contain a dataframe, please use load_dataframe to load a dataframe"
             )
 
     def create_xgb(self, verbosity=0):
-        """Constructs the XGBoost classifier. Parameters provided by Greg Ridgeway."""
-        self.xgb_cl = xgb.XGBClassifier(max_depth=2,
-                                        n_estimators=3000,
+        """Constructs the XGBoost classifier from the training policy. Default 
+        parameters provided by Greg Ridgeway. The round budget scales with the
+        number of rows in X if the policy sets rounds_per_row."""
+        policy = self.training_policy
+        n_rows = len(self.X) if hasattr(self, "X") else None
+        self.rounds_budget = policy.rounds_for(n_rows)
+        self.xgb_cl = xgb.XGBClassifier(max_depth=policy.max_depth,
+                                        n_estimators=self.rounds_budget,
                                         objective="binary:logistic",
-                                        learning_rate=0.01,
+                                        learning_rate=policy.learning_rate,
                                         eval_metric='logloss',
+                                        tree_method=policy.tree_method,
+                                        random_state=policy.random_state,
                                         verbosity=verbosity,
+                                        n_jobs=self.n_jobs,
+                                        missing=np.nan,
                                         use_label_encoder=False)
 
-    def process_X_y(self):
-        """Converts X and y dataframes to matrices to prepare them for fitting into the classifier"""
-        self.X_processed = self.full_processor.fit_transform(self.X)
+    def process_X_y(self, fit=True):
+        """Converts X and y dataframes to matrices to prepare them for fitting into the classifier.
+        fit=False reuses an already fitted processor, e.g. one loaded from the model cache."""
+        if fit:
+            self.X_processed = self.full_processor.fit_transform(self.X)
+        else:
+            self.X_processed = self.full_processor.transform(self.X)
         self.y_processed = SimpleImputer(
             strategy="most_frequent").fit_transform(
                 self.y.values.reshape(-1, 1))
 
-    def fit_xgb(self):
-        """Fits the classifier on X_processes and y_processed"""
-        self.xgb_cl.fit(self.X_processed, self.y_processed, verbose=2)
+    def model_rounds(self):
+        """Boosting rounds the fitted classifier predicts with: its best
+        iteration after early stopping without refit, else all its trees."""
+        booster = self.xgb_cl.get_booster()
+        best_iteration = booster.attr("best_iteration")
+        if best_iteration is not None:
+            return int(best_iteration) + 1
+        return booster.num_boosted_rounds()
+
+    def fit_xgb(self, init_model=None):
+        """Fits the classifier on X_processes and y_processed. If init_model is
+        given, boosting continues from it for warm_start_rounds extra rounds.
+        rounds_used is the number of rounds the fitted model predicts with 
+        (see model_rounds), including the rounds of init_model.
+
+        With early stopping in the training policy, the classifier is first fit
+        on a stratified split and stopped on the held-out logloss, then (if 
+        refit is set) refit on the whole cell with the rounds actually used.
+        Early stopping is skipped if either label has fewer than 2 rows.
+        Sets rounds_used, fit_seconds and seconds_saved, an estimate of the
+        fitting time saved against the full round budget."""
+        policy = self.training_policy
+        start_time = time.perf_counter()
+        y = self.y_processed.ravel()
+        counts = pd.Series(y).value_counts()
+        can_stop_early = (policy.early_stopping_rounds is not None
+                          and init_model is None and len(counts) == 2
+                          and counts.min() >= 2)
+        if init_model is not None:
+            # an early stopped base model would limit the prediction rounds
+            init_model = init_model.copy()
+            init_model.set_attr(best_iteration=None, best_score=None, best_ntree_limit=None)
+            self.xgb_cl.set_params(n_estimators=self.warm_start_rounds)
+            self.xgb_cl.fit(self.X_processed, self.y_processed, verbose=2,
+                            xgb_model=init_model)
+        elif can_stop_early:
+            X_train, X_valid, y_train, y_valid = train_test_split(
+                self.X_processed, y, test_size=policy.validation_fraction,
+                stratify=y, random_state=policy.random_state)
+            self.xgb_cl.set_params(
+                early_stopping_rounds=policy.early_stopping_rounds)
+            self.xgb_cl.fit(X_train, y_train, eval_set=[(X_valid, y_valid)],
+                            verbose=False)
+            best_rounds = self.xgb_cl.best_iteration + 1
+            rounds_trained = self.xgb_cl.get_booster().num_boosted_rounds()
+            if policy.refit:
+                self.xgb_cl.set_params(n_estimators=best_rounds,
+                                       early_stopping_rounds=None)
+                self.xgb_cl.fit(self.X_processed, self.y_processed, verbose=2)
+                rounds_trained += best_rounds
+        else:
+            self.xgb_cl.fit(self.X_processed, self.y_processed, verbose=2)
+        self.rounds_used = self.model_rounds()
+        self.fit_seconds = time.perf_counter() - start_time
+        if can_stop_early and rounds_trained:
+            seconds_per_round = self.fit_seconds / rounds_trained
+            self.seconds_saved = max(
+                0.0, seconds_per_round * (self.rounds_budget - rounds_trained))
+        else:
+            self.seconds_saved = 0.0
+
+    def cache_params(self, warm_source=None):
+        """Hyperparameters that identify a fitted model in the model cache.
+        Thread counts and verbosity do not change the model and are left out."""
+        params = {key: value for key, value in self.xgb_cl.get_params().items()
+                  if key not in ("n_jobs", "verbosity")}
+        params["warm_start_rounds"] = self.warm_start_rounds
+        params["warm_start_rebase_months"] = self.warm_start_rebase_months
+        params["training_policy"] = vars(self.training_policy)
+        params["sparse"] = self.sparse
+        params["warm_start_from"] = warm_source
+        return params
+
+    def fit_or_load(self, warm_start_key=None):
+        """Builds the processor and fits the classifier, going through the model
+        cache when one is set:
+        - cache hit: the fitted processor and classifier are loaded from disk
+        - cache miss: the model is fit and stored in the cache
+        warm_start_key is the cell's (precinct, year, month). If the previous
+        month of the same precinct has a warm start pointer, the cell continues
+        from that chain's base model: it is encoded with the base model's
+        processor (the base month's category vocabulary, categories it has not
+        seen are ignored) and warm_start_rounds rounds are added to the base
+        booster, so every model has at most base + warm_start_rounds trees.
+        Otherwise, or once the chain is warm_start_rebase_months old, the cell
+        is fit from scratch and becomes the base of a new chain. The base 
+        model's cache key is part of this cell's key, so the key only changes
+        when the data of this cell or of its base month changes. Raises a
+        ValueError if the base model was fit on other input columns."""
+        if self.model_cache is None:
+            with self._stage("pipeline_build"):
+                self.create_pipeline()
+            with self._stage("process_X_y") as info:
+                self.process_X_y()
+                info.update(self._processed_shape())
+            with self._stage("fit") as info:
+                self.fit_xgb()
+                info.update(rounds_used=self.rounds_used)
+            return
+
+        settings = json.dumps(self.cache_params(), sort_keys=True, default=str)
+        warm = None
+        if warm_start_key is not None:
+            warm = self.model_cache.get_warm_start(previous_cell(warm_start_key))
+            if warm is not None and (warm[2].get("params") != settings or
+                                     warm[2]["age"] + 1 >= self.warm_start_rebase_months):
+                warm = None
+            if warm is not None and list(warm[1].feature_names_in_) != list(self.X.columns):
+                raise ValueError(
+                    f"warm_start: the base model of {previous_cell(warm_start_key)} was fit on "
+                    f"the columns {list(warm[1].feature_names_in_)}, not {list(self.X.columns)}. "
+                    f"Clear the model cache or run without warm_start.")
+        base_key = warm[2]["base_key"] if warm is not None else None
+        key = self.model_cache.make_key(self.X, self.y,
+                                        self.cache_params(base_key))
+        self.warm_started = warm is not None
+        with self._stage("cache_lookup") as info:
+            cached = self.model_cache.get(key)
+            info.update(cache_hit=cached is not None)
+        if cached is not None:
+            self.logger.info("Loaded fitted model from cache")
+            self.cache_hit = True
+            self.xgb_cl, self.full_processor = cached
+            self.xgb_cl.set_params(n_jobs=self.n_jobs)
+            self.rounds_used = self.model_rounds()
+            with self._stage("process_X_y") as info:
+                self.process_X_y(fit=False)
+                info.update(self._processed_shape())
+        elif warm is not None:
+            self.logger.info(f"Warm starting from the base model of {previous_cell(warm_start_key)}")
+            self.full_processor = warm[1]
+            with self._stage("process_X_y") as info:
+                self.process_X_y(fit=False)
+                info.update(self._processed_shape())
+            with self._stage("fit") as info:
+                self.fit_xgb(warm[0].get_booster())
+                info.update(rounds_used=self.rounds_used, warm_started=True)
+        else:
+            with self._stage("pipeline_build"):
+                self.create_pipeline()
+            with self._stage("process_X_y") as info:
+                self.process_X_y()
+                info.update(self._processed_shape())
+            with self._stage("fit") as info:
+                self.fit_xgb()
+                info.update(rounds_used=self.rounds_used, warm_started=False)
+        if not self.cache_hit or warm_start_key is not None:
+            with self._stage("cache_store"):
+                if not self.cache_hit:
+                    self.model_cache.put(key, self.xgb_cl, self.full_processor)
+                if warm_start_key is not None:
+                    pointer = {"source_key": key, "base_key": base_key or key,
+                               "age": warm[2]["age"] + 1 if warm is not None else 0,
+                               "params": settings}
+                    self.model_cache.put_warm_start(warm_start_key, pointer)
 
     def predict(self):
         """Runs the prediction and probability calculations for the fitted classifier
@@ -181,29 +475,50 @@ class xgb_psm():
         self.evaluated_data['probability_1'] = self.probabilities[:,
                                                                   -1].tolist()
 
-    def generate_weights(self, label_col):
-        self.evaluated_data['weight'] = self.evaluated_data.apply(
-            lambda x: 1 if x[label_col] == 1 else x['probability_1']/(1-x['probability_1']), axis = 1
-        )
+    def generate_weights(self, label_col, method="att", trim=None, clip=None,
+                         stabilized=False):
+        """Generates the propensity weights from probability_1 and the labels.
+        The default ATT weights are 1 for label 1 and p/(1-p) for label 0. See
+        public_psm_estimation.compute_weights for the ATE, trimming, clipping
+        and stabilized options."""
+        self.evaluated_data['weight'] = compute_weights(
+            self.evaluated_data['probability_1'].values,
+            self.evaluated_data[label_col].values,
+            method=method, trim=trim, clip=clip, stabilized=stabilized)
 
     def extract_model_weights(self):
         """Extracts the model weights from the fitted classifier and converts 
         them back into the original label names for human readability."""
 
-        features = self.X.columns
-        feature_map = self.full_processor.transformers_[1][1][
-            'oh-encode'].get_feature_names(features).tolist()
-        self.xgb_cl.get_booster().feature_names = feature_map
+        # the classifier is fit on a matrix, so the booster names its features
+        # f0, f1, ... in the column order of the processor output
+        feature_map = self.feature_names()
         feature_important = self.xgb_cl.get_booster().get_score(
             importance_type='weight')
-        keys = list(feature_important.keys())
+        keys = [feature_map[int(key[1:])] for key in feature_important.keys()]
         values = list(feature_important.values())
         self.model_weights = pd.DataFrame(data=values,
                                           index=keys,
                                           columns=["weight"]).sort_values(
                                               by="weight", ascending=True)
     
-    def absolute_difference(self, label_col):
+    def feature_names(self):
+        """Returns the original feature names for the columns of X_processed:
+        the numeric columns followed by <column>_<value> for every one-hot 
+        encoded category. Works for the dense and the sparse pipeline."""
+        feature_map = []
+        for name, transformer, columns in self.full_processor.transformers_:
+            if name == "numeric":
+                feature_map += list(columns)
+            elif name == "categorical":
+                encoder = transformer['oh-encode']
+                if hasattr(encoder, "get_feature_names_out"):
+                    feature_map += encoder.get_feature_names_out(columns).tolist()
+                else:
+                    feature_map += encoder.get_feature_names(columns).tolist()
+        return feature_map
+
+    def absolute_difference(self, label_col, broadcast=True):
         """
         The absolute difference is calculated at a per row basis per exsperiment. 
         The sum because it should be summed over each exsperiment?
@@ -216,12 +531,24 @@ class xgb_psm():
         absolute_difference = mean_treat - mean_control
         
         The sum is done per experiment. 
+
+        The weighted means for the experiment are stored in self.estimate as
+        a single record (see public_psm_estimation.weighted_difference). With 
+        broadcast=False only self.estimate is produced and no per-row columns
+        are added to evaluated_data.
         """
         frisk_conversion = {'Y': 1,'N': 0}
-        frisk = self.evaluated_data["Frisk Flag"].map(frisk_conversion)
+        # astype(object) so a categorical Frisk Flag (e.g. read from parquet)
+        # maps to plain numbers
+        frisk = self.evaluated_data["Frisk Flag"].astype(object).map(frisk_conversion)
         weight = self.evaluated_data['weight']
         label = self.evaluated_data[label_col]
 
+        self.estimate = weighted_difference(frisk.values, label.values,
+                                            weight.values)
+        if not broadcast:
+            return
+
         mean_control = (1-label)*weight*frisk / (1-label)*weight    
         mean_treat = (label*frisk) / label
 
@@ -233,40 +560,214 @@ class xgb_psm():
         self.evaluated_data["mean_treat_sum"] = self.evaluated_data['mean_treat'].sum()
         self.evaluated_data["absolute_difference"] = self.evaluated_data["mean_treat_sum"] - self.evaluated_data["mean_control_sum"]
 
-    def just_send_it(self, df, control_col, control_val, drop_cols, label_col):
+    def just_send_it(self, df, control_col, control_val, drop_cols, label_col,
+                     warm_start_key=None):
         """Automatically runs all the required methods to prep the data, fit the 
         model, calculate the predictions and the probabilities, and the feature
-        weights."""
+        weights. warm_start_key (the cell's (precinct, year, month)) is only 
+        used with a model cache, see fit_or_load()."""
 
         self.logger.info("Loading Dataframe")
         self.load_dataframe(df)
-        self.logger.info("Creating Labels")
-        self.create_labels(control_col, control_val, label_col)
-        self.logger.info("Separating X and y")
-        self.separate_X_y(drop_cols, label_col)
-        self.logger.info("Creating Pipelines")
-        self.create_pipeline()
+        with self._stage("labeling") as info:
+            self.logger.info("Creating Labels")
+            self.create_labels(control_col, control_val, label_col)
+            self.logger.info("Separating X and y")
+            self.separate_X_y(drop_cols, label_col)
+            info.update(rows=len(self.X), columns=self.X.shape[1])
         self.logger.info("Creating XGBoost Classifier")
         self.create_xgb()
-        self.logger.info("Converting X and y to matrices")
-        self.process_X_y()
-        self.logger.info("Fitting Classifier on X and y")
-        self.fit_xgb()
-        self.logger.info("Calculating Predictions and Probabilities")
-        self.predict()
-        self.logger.info("Generating Weights")
-        self.generate_weights(label_col)
-        self.logger.info("Calculating absolute difference")
-        self.absolute_difference(label_col)
-
-
-def evaluate_all_stops(df):
+        self.logger.info("Creating pipelines, converting X and y to matrices and fitting Classifier")
+        self.fit_or_load(warm_start_key)
+        with self._stage("predict") as info:
+            self.logger.info("Calculating Predictions and Probabilities")
+            self.predict()
+            info.update(rows=len(self.evaluated_data))
+        with self._stage("weighting") as info:
+            self.logger.info("Generating Weights")
+            self.generate_weights(label_col)
+            self.logger.info("Calculating absolute difference")
+            self.absolute_difference(label_col)
+            info.update(n_treat=self.estimate["n_treat"], n_control=self.estimate["n_control"])
+
+
+def _iterate_cells(df):
+    """Yields the (precinct, year, month) cells of df in the order 
+    evaluate_all_stops processes them: precincts in a fixed order, then
+    years and months in chronological order (warm start follows it)."""
+    precincts = ["NORTH", "EAST", "SOUTH", "WEST", "SOUTHWEST"]
+    # Filter on Precinct
+    for precinct in precincts:
+        precinct_df = df[df.precinct == precinct]
+        years = sorted(precinct_df.observation_year_d.unique())
+        # Filter on year
+        for year in years:
+            year_df = precinct_df[precinct_df.observation_year_d == year]
+            months = sorted(year_df.observation_month_d.unique())
+            # Filter on Month
+            for month in months:
+                yield year_df[year_df.observation_month_d == month]
+
+
+def _evaluate_cell(month_df, control_col, control_val, drop_cols, label_col,
+                   n_jobs=None, model_cache=None, warm_start=False,
+                   training_policy=None, sparse=False, instrument=False,
+                   track_memory=True):
+    """Runs the PSM for a single precinct/year/month cell. Kept at module level
+    so it can be shipped to a process pool. With instrument=True the cell's 
+    stages are recorded by a psm_instrumentation created in this process.
+
+    Returns:
+        eval_flag: True if the cell had enough records to be evaluated
+        row: the summary row for the cell
+        evaluated_data: the evaluator output, or None if the cell was skipped
+        stage_records: the cell's stage records (empty if not instrumented)
+    """
+    evaluated_data = None
+    instrumentation = None
+    if instrument:
+        instrumentation = psm_instrumentation(track_memory=track_memory, context={
+            "precinct": month_df.precinct.iloc[0],
+            "observation_year_d": int(month_df.observation_year_d.iloc[0]),
+            "observation_month_d": int(month_df.observation_month_d.iloc[0]),
+            "cell_rows": len(month_df),
+        })
+    # Check if it has more than 10 records
+    if len(month_df) > 10:
+        eval_flag = True
+        start_time = datetime.now()
+        evaluator = xgb_psm(verbosity=0, n_jobs=n_jobs, model_cache=model_cache,
+                            training_policy=training_policy, sparse=sparse,
+                            instrumentation=instrumentation)
+        warm_start_key = None
+        if warm_start:
+            warm_start_key = (month_df.precinct.iloc[0],
+                              int(month_df.observation_year_d.iloc[0]),
+                              int(month_df.observation_month_d.iloc[0]))
+
+        evaluator.just_send_it(month_df,
+                               control_col=control_col,
+                               control_val=control_val,
+                               drop_cols=drop_cols,
+                               label_col=label_col,
+                               warm_start_key=warm_start_key)
+
+        run_time = datetime.now() - start_time
+        evaluated_data = evaluator.evaluated_data
+        high_prop = evaluated_data.weight.max()
+        low_prop = evaluated_data.weight.min()
+        mean_prop = evaluated_data.weight.mean()
+        estimate = evaluator.estimate
+        cache_hit = evaluator.cache_hit
+        warm_started = evaluator.warm_started if warm_start else None
+        rounds_budget = evaluator.rounds_budget
+        rounds_used = evaluator.rounds_used
+        seconds_saved = evaluator.seconds_saved
+        assessed = "Yes"
+    else:
+        # If you skip the evaluation of records, write out the
+        # flags appropriately
+        eval_flag = False
+        assessed = "No"
+        run_time = None
+        high_prop = None
+        low_prop = None
+        mean_prop = None
+        estimate = {}
+        cache_hit = None
+        warm_started = None
+        rounds_budget = None
+        rounds_used = None
+        seconds_saved = None
+
+    num_0 = month_df[month_df['Subject Perceived Race'] == "White"].shape[0]
+    num_1 = month_df[month_df['Subject Perceived Race'] != "White"].shape[0]
+    row = {
+        "precinct": month_df.precinct.iloc[0],
+        "observation_year_d": int(month_df.observation_year_d.iloc[0]),
+        "observation_month_d": int(month_df.observation_month_d.iloc[0]),
+        "total_records": len(month_df),
+        "attempted_to_assess": assessed,
+        "label_0_records_count": num_0,
+        "label_1_records_count": num_1,
+        "highest_propensity_pred": high_prop,
+        "lowest_propensity_pred": low_prop,
+        "mean_propensity_pred": mean_prop,
+        "weighted_mean_treat": estimate.get("mean_treat"),
+        "weighted_mean_control": estimate.get("mean_control"),
+        "weighted_difference": estimate.get("difference"),
+        "control_effective_size": estimate.get("ess_control"),
+        "loaded_from_cache": cache_hit,
+        "warm_started": warm_started,
+        "boosting_rounds_budget": rounds_budget,
+        "boosting_rounds_used": rounds_used,
+        "estimated_seconds_saved": seconds_saved,
+        "run_time": str(run_time),
+    }
+    stage_records = []
+    if instrumentation is not None:
+        stage_records = instrumentation.records
+        row.update(instrumentation.summary_columns())
+    return eval_flag, row, evaluated_data, stage_records
+
+
+def _bounded_map(executor, cells, cell_args, max_pending):
+    """Runs _evaluate_cell for every cell on executor with at most max_pending
+    cells in flight, yielding the results in cell order."""
+    pending = deque()
+    for cell in cells:
+        pending.append(executor.submit(_evaluate_cell, cell, *cell_args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def evaluate_all_stops(df, n_workers=1, xgb_threads=None, collector=None,
+                       model_cache=None, warm_start=False, training_policy=None,
+                       sparse=False, instrumentation=None, max_pending=None):
     """Function tightly coupled to the xgb_psm class that enables bulk processing
     of all records in a given dataframe. Currently scoped to Precinct, Year, Month 
     intervals. 
 
+    Cells are independent of each other, so with n_workers > 1 they are spread
+    across a process pool. Results are merged back in the same order as the
+    sequential run, so the output does not depend on the number of workers.
+
     Args:
         df (pandas dataframe): the dataframe to be evaluated
+        n_workers (int): number of worker processes. 1 (default) runs every
+                         cell in the current process.
+        xgb_threads (int): number of XGBoost threads per cell. Defaults to
+                           XGBoost's own choice for a sequential run and to
+                           cpu_count // n_workers for a parallel run.
+        collector (psm_result_collector): collects the per-cell outputs. 
+                           Pass one to stream propensities to part files 
+                           or to filter/rename their columns per cell. 
+                           Defaults to an in-memory collector.
+        model_cache (psm_model_cache): reuse fitted models of cells whose
+                           data has not changed since an earlier run.
+        warm_start (bool): with a model_cache, continue boosting from the
+                           base model of the precinct's chain of months, 
+                           see xgb_psm.fit_or_load. The summary column 
+                           warm_started shows which cells did. Depends on
+                           cell order, so it requires n_workers=1.
+        training_policy (xgb_training_policy): round budget, early stopping
+                           and tree method for every cell. Defaults to the
+                           original fixed 3000 round budget.
+        sparse (bool): encode features into CSR matrices instead of dense 
+                           arrays, see xgb_psm.
+        instrumentation (psm_instrumentation): record the time, peak memory
+                           and shapes of every stage of every cell. The 
+                           records (with the cell's precinct, year, month 
+                           and rows) are passed to its sinks and kept in 
+                           instrumentation.records, and the per-stage 
+                           seconds and peak bytes are added to the summary.
+        max_pending (int): with n_workers > 1, cells submitted to the pool 
+                           and not yet collected. Cells are cut from df 
+                           only as they are submitted, so at most this 
+                           many cell copies are in flight. Defaults to
+                           2 * n_workers.
 
     Returns:
         summary_df: a summary dataframe of the experiments that include:
@@ -287,15 +788,9 @@ def evaluate_all_stops(df):
 
     """
 
-    # Initialize the summary_df dataframe
-    summary_df = pd.DataFrame({
-        'total_records': pd.Series(dtype='int'),
-        'attempted_to_assess': pd.Series(dtype='str'),
-        'label_0_records_count': pd.Series(dtype='int'),
-        'label_1_records_count': pd.Series(dtype='int'),
-    })
-
-    propensity_df = pd.DataFrame()
+    # Cell outputs are buffered and each result frame is built once at the end
+    if collector is None:
+        collector = psm_result_collector()
 
     # Setting up the default variables.
 
@@ -308,65 +803,35 @@ def evaluate_all_stops(df):
     label_col = 'label'
     print(f"Found {len(df)} potential records to evaluate...")
 
-    precincts = ["NORTH", "EAST", "SOUTH", "WEST", "SOUTHWEST"]
-    # Filter on Precinct
+    if warm_start and (model_cache is None or n_workers > 1):
+        raise ValueError("warm_start requires a model_cache and n_workers=1")
+    if n_workers > 1 and xgb_threads is None:
+        xgb_threads = max(1, (os.cpu_count() or 1) // n_workers)
+
     time_assessed = datetime.today()
-    for precinct in precincts:
-        precinct_df = df[df.precinct == precinct]
-        years = precinct_df.observation_year_d.unique()
-        # Filter on year
-        for year in years:
-            year_df = precinct_df[precinct_df.observation_year_d == year]
-            months = year_df.observation_month_d.unique()
-            # Filter on Month
-            for month in months:
-                month_df = year_df[year_df.observation_month_d == month]
-                # Check if it has more than 10 records
-                if len(month_df) > 10:
-                    eval_flag = True
-                    start_time = datetime.now()
-                    evaluator = xgb_psm(verbosity=0)
-                    
-                    evaluator.just_send_it(month_df,
-                                           control_col=control_col,
-                                           control_val=control_val,
-                                           drop_cols=drop_cols,
-                                           label_col=label_col)
-                    
-                    run_time = datetime.now() - start_time
-                    high_prop = evaluator.evaluated_data.weight.max()
-                    low_prop = evaluator.evaluated_data.weight.min()
-                    mean_prop = evaluator.evaluated_data.weight.mean()
-                    assessed = "Yes"
-                else:
-                    # If you skip the evaluation of records, write out the
-                    # flags appropriately
-                    eval_flag = False
-                    assessed = "No"
-                    run_time = None
-                    high_prop = None 
-                    low_prop = None
-                    mean_prop = None
-
-                num_0 = month_df[month_df['Subject Perceived Race'] == "White"].shape[0]
-                num_1 = month_df[month_df['Subject Perceived Race'] != "White"].shape[0]
-                row = {
-                    "total_records": len(month_df),
-                    "attempted_to_assess": assessed,
-                    "label_0_records_count": num_0,
-                    "label_1_records_count": num_1,
-                    "highest_propensity_pred": high_prop,
-                    "lowest_propensity_pred": low_prop,
-                    "mean_propensity_pred": mean_prop,
-                    "run_time": str(run_time),
-                    "run_timestamp": time_assessed
-                }
-                summary_df = summary_df.append(row, ignore_index=True)
-                if eval_flag:
-                    propensity_df = propensity_df.append(
-                        evaluator.evaluated_data
-                    )
-                    propensity_df['run_timestamp'] = time_assessed
-                else:
-                    pass
-    return eval_flag, summary_df, propensity_df
\ No newline at end of file
+    cell_args = (control_col, control_val, drop_cols, label_col, xgb_threads,
+                 model_cache, warm_start, training_policy, sparse,
+                 instrumentation is not None,
+                 instrumentation.track_memory if instrumentation is not None else False)
+    if n_workers > 1:
+        if max_pending is None:
+            max_pending = 2 * n_workers
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        results = _bounded_map(executor, _iterate_cells(df), cell_args, max_pending)
+    else:
+        executor = None
+        results = (_evaluate_cell(cell, *cell_args) for cell in _iterate_cells(df))
+
+    # Both variants yield results in cell order
+    eval_flag = False
+    try:
+        for eval_flag, row, evaluated_data, stage_records in results:
+            collector.add_cell(row, evaluated_data, run_timestamp=time_assessed)
+            # sinks run here rather than in the workers
+            for record in stage_records:
+                instrumentation.records.append(record)
+                instrumentation.emit(record)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return eval_flag, collector.summary_frame(), collector.propensity_frame()
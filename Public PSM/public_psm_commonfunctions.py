@@ -71,19 +71,72 @@ def watch_from_squad_desc (input, timestamp):
     return watch
 
 
+# watch start times as offsets from midnight, see watch_from_squad_desc
+_first_watch_start = pd.Timedelta(hours=3)
+_second_watch_start = pd.Timedelta(hours=11)
+_third_watch_start = pd.Timedelta(hours=19)
+_last_second = pd.Timedelta(hours=23, minutes=59, seconds=59)
+
+def vectorized_watch_from_squad_desc (squad, timestamps):
+    """Columnar version of watch_from_squad_desc for whole columns, e.g.
+
+        full_df['watch_d'] = vectorized_watch_from_squad_desc(full_df['Officer Squad'], full_df['observation_datetime_d'])
+
+    Gives the same results as applying watch_from_squad_desc row by row: the watch
+    in the squad description wins ('1ST', then '2ND', then '3RD'), otherwise the 
+    watch is binned from the time of day. A null timestamp gives None and a time
+    after 23:59:59 falls back to the upper-cased squad description.
+    """
+    squad_upper = squad.astype(str).str.upper()
+    timestamps = pd.to_datetime(timestamps)
+    time_of_day = timestamps - timestamps.dt.normalize()
+    has_time = timestamps.notna()
+
+    watch = np.select(
+        [
+            squad_upper.str.contains('1ST', regex=False),
+            squad_upper.str.contains('2ND', regex=False),
+            squad_upper.str.contains('3RD', regex=False),
+            ~has_time,
+            (time_of_day >= _first_watch_start) & (time_of_day < _second_watch_start),
+            (time_of_day >= _second_watch_start) & (time_of_day < _third_watch_start),
+            (time_of_day >= _third_watch_start) & (time_of_day <= _last_second),
+            time_of_day < _first_watch_start,
+        ],
+        ['1ST', '2ND', '3RD', None, '1ST', '2ND', '3RD', '3RD'],
+        default=squad_upper.to_numpy(dtype=object),
+    )
+    return pd.Series(watch, index=squad.index, dtype=object)
+
+def normalize_precinct (precinct):
+    """Strips a trailing ' PCT' and upper-cases precinct names for a whole column."""
+    precinct = precinct.astype(str)
+    return precinct.where(~precinct.str.endswith(' PCT'), precinct.str[:-4]).str.upper()
+
+def precinct_watch (precinct, watch):
+    """Builds <PRECINCT>_<WATCH> for rows with a 1ST/2ND/3RD watch, other rows keep
+    their watch value. Columnar replacement for the row-wise Precinct_watch_d apply."""
+    has_watch = watch.isin(['1ST', '2ND', '3RD'])
+    return (precinct + '_' + watch).where(has_watch, watch)
+
+
 def get_rolling_count(grp, freq, time_field='observation_datetime_d', count_field='Terry Stop ID'):
     return grp.rolling(freq, on=time_field, closed = 'left')[count_field].count()
 
-def generate_features (df, group_by_key, feature_name, lookback_period):
-    
+def lookback_to_time_period (lookback_period):
     if lookback_period.endswith('M'):
         time_period = f'{30*int(lookback_period[:-1])}D'
     elif lookback_period.endswith('Y'):
         time_period = f'{365*int(lookback_period[:-1])}D'
     elif lookback_period.endswith('D'):
-        time_period = f'{lookback_period}D'
+        time_period = lookback_period
     else:
         raise Exception ('Lookback_period not supported. Support input types are *D, *M, *Y.')
+    return time_period
+
+def generate_features (df, group_by_key, feature_name, lookback_period):
+    
+    time_period = lookback_to_time_period(lookback_period)
 
     df[f'{feature_name}_{lookback_period}'] = df.groupby(
         group_by_key, as_index=False, group_keys=False
@@ -91,3 +144,72 @@ def generate_features (df, group_by_key, feature_name, lookback_period):
 
     return df
 
+
+def _window_counts (group_codes, times, valid, windows):
+    """Counts, for every row, the rows of the same group in [t - window, t) that 
+    come before it, for each window in one pass over group-sorted arrays.
+
+    group_codes: int array of group ids in row order (-1 = no group)
+    times: int64 array of timestamps in row order
+    valid: bool array, True where the count field is not null
+    windows: list of int64 window lengths (same unit as times)
+
+    Matches pandas rolling(window, closed='left').count() on each group: rows are 
+    taken in their original order within a group, a row with no earlier rows in 
+    its window gets NaN and a window with only null values gets 0.
+    Returns a list of float arrays in row order, one per window.
+    """
+    n = len(times)
+    # stable sort keeps the original row order within each group, like groupby
+    order = np.argsort(group_codes, kind='stable')
+    codes_sorted = group_codes[order]
+    times_sorted = times[order]
+    if n > 1:
+        same_group = codes_sorted[1:] == codes_sorted[:-1]
+        if (same_group & (times_sorted[1:] < times_sorted[:-1])).any():
+            raise ValueError('Time field must be monotonic within each group.')
+
+    # Give every (group, time) a position in one sorted key so a single 
+    # searchsorted finds each window start inside the row's own group.
+    unique_times = np.unique(times_sorted)
+    time_rank = np.searchsorted(unique_times, times_sorted)
+    stride = len(unique_times) + 1
+    key = codes_sorted.astype(np.int64) * stride + time_rank
+    valid_cumsum = np.concatenate(([0], np.cumsum(valid[order])))
+    positions = np.arange(n)
+
+    results = []
+    for window in windows:
+        start_rank = np.searchsorted(unique_times, times_sorted - window, side='left')
+        start = np.searchsorted(key, codes_sorted.astype(np.int64) * stride + start_rank, side='left')
+        counts = (valid_cumsum[positions] - valid_cumsum[start]).astype(float)
+        counts[positions == start] = np.nan
+        counts[codes_sorted < 0] = np.nan
+        result = np.empty(n)
+        result[order] = counts
+        results.append(result)
+    return results
+
+def generate_multi_window_features (df, group_by_key, feature_name, lookback_periods,
+                                    time_field='observation_datetime_d', count_field='Terry Stop ID'):
+    """Computes {feature_name}_{period} for every lookback period in one sorted pass.
+
+    Produces the same columns as calling generate_features once per period, so
+    the feature engineering notebook can replace its per-period loops:
+
+        df = generate_multi_window_features(df, ['Subject ID'], 'n_subject_stopped', ['3M', '6M', '1Y', '2Y', '3Y'])
+
+    As with generate_features, rows whose group key is null get NaN and the time
+    field must be sorted within each group.
+    """
+    # rows with a null key are not in any group (NaN or -1 depending on pandas version)
+    group_codes = df.groupby(group_by_key, sort=False).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    times = df[time_field].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    valid = df[count_field].notna().to_numpy()
+    windows = [pd.Timedelta(lookback_to_time_period(period)).value for period in lookback_periods]
+
+    counts = _window_counts(group_codes, times, valid, windows)
+    for period, values in zip(lookback_periods, counts):
+        df[f'{feature_name}_{period}'] = values
+    return df
+
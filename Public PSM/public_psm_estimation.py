@@ -0,0 +1,122 @@
+import numpy as np
+
+
+def att_weights(probability_1, label):
+    """ATT (odds) weights: 1 for treated rows (label 1) and p/(1-p) for
+    control rows (label 0), where p is the probability of label 1."""
+    p = np.asarray(probability_1, dtype=float)
+    label = np.asarray(label)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(label == 1, 1.0, p / (1 - p))
+
+
+def ate_weights(probability_1, label):
+    """ATE (inverse probability) weights: 1/p for treated rows and 1/(1-p) for
+    control rows."""
+    p = np.asarray(probability_1, dtype=float)
+    label = np.asarray(label)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(label == 1, 1 / p, 1 / (1 - p))
+
+
+def trim_mask(probability_1, trim):
+    """Returns a boolean mask of rows whose probability lies within
+    [trim, 1 - trim]. Rows outside the band are dropped from the estimate."""
+    p = np.asarray(probability_1, dtype=float)
+    return (p >= trim) & (p <= 1 - trim)
+
+
+def stabilize_weights(weights, label, method="att"):
+    """Stabilizes weights so each group keeps its own sample size.
+
+    ATE: weights are multiplied by the marginal probability of the row's group.
+    ATT: control weights are rescaled to sum to the number of control rows;
+         treated weights are left at 1.
+    """
+    weights = np.asarray(weights, dtype=float).copy()
+    label = np.asarray(label)
+    treated = label == 1
+    control = ~treated
+    if method == "ate":
+        share_treated = treated.mean() if len(label) else 0.0
+        weights[treated] *= share_treated
+        weights[control] *= 1 - share_treated
+    elif method == "att":
+        total = weights[control].sum()
+        if total > 0:
+            weights[control] *= control.sum() / total
+    else:
+        raise ValueError(f"Weighting method {method} not supported. Supported methods are att, ate.")
+    return weights
+
+
+def compute_weights(probability_1, label, method="att", trim=None, clip=None,
+                    stabilized=False):
+    """Computes propensity weights from arrays of probability_1 and labels.
+
+    Args:
+        probability_1 (array): probability of label 1 for every row
+        label (array): 0 for control rows, 1 for treated rows
+        method (str): "att" for odds weights (the default, matches
+                      xgb_psm.generate_weights) or "ate" for inverse
+                      probability weights
+        trim (float): drop rows with probability outside [trim, 1 - trim] by
+                      giving them a weight of 0
+        clip (tuple): (lower, upper) bounds the weights are clipped to. Either
+                      bound may be None.
+        stabilized (bool): stabilize the weights, see stabilize_weights()
+
+    Returns:
+        numpy array of weights
+    """
+    if method == "att":
+        weights = att_weights(probability_1, label)
+    elif method == "ate":
+        weights = ate_weights(probability_1, label)
+    else:
+        raise ValueError(f"Weighting method {method} not supported. Supported methods are att, ate.")
+    if clip is not None:
+        lower, upper = clip
+        weights = np.clip(weights, lower, upper)
+    if trim is not None:
+        weights = np.where(trim_mask(probability_1, trim), weights, 0.0)
+    if stabilized:
+        weights = stabilize_weights(weights, label, method)
+    return weights
+
+
+def weighted_difference(outcome, label, weights):
+    """Computes the weighted outcome difference for a single experiment.
+
+    mean_control = sum((1-label)*weight*outcome) / sum((1-label)*weight)
+    mean_treat = sum(label*weight*outcome) / sum(label*weight)
+    difference = mean_treat - mean_control
+
+    Rows with a missing outcome are left out. Returns a dict with the means,
+    the difference, the group sizes and the effective sample size of the
+    control group.
+    """
+    outcome = np.asarray(outcome, dtype=float)
+    label = np.asarray(label)
+    weights = np.asarray(weights, dtype=float)
+    keep = ~np.isnan(outcome)
+    outcome, label, weights = outcome[keep], label[keep], weights[keep]
+
+    treated = label == 1
+    control = ~treated
+    w_treat = weights[treated]
+    w_control = weights[control]
+    sum_treat = w_treat.sum()
+    sum_control = w_control.sum()
+    mean_treat = (w_treat * outcome[treated]).sum() / sum_treat if sum_treat else np.nan
+    mean_control = (w_control * outcome[control]).sum() / sum_control if sum_control else np.nan
+    sum_sq_control = (w_control ** 2).sum()
+    ess_control = sum_control ** 2 / sum_sq_control if sum_sq_control else np.nan
+    return {
+        "mean_treat": mean_treat,
+        "mean_control": mean_control,
+        "difference": mean_treat - mean_control,
+        "n_treat": int(treated.sum()),
+        "n_control": int(control.sum()),
+        "ess_control": ess_control,
+    }
@@ -0,0 +1,182 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+
+from public_psm_commonfunctions import generate_multi_window_features, lookback_to_time_period
+
+lookback_periods = ['3M', '6M', '1Y', '2Y', '3Y']
+
+cols_for_subject_features = [
+    'Terry Stop ID', 'Subject ID', 'observation_datetime_d',
+    'Precinct', 'Officer ID', 'weapon_type', 'Subject Perceived Race', 'Frisk Flag'
+]
+
+# (grouping key, feature name) for the rolling count features of
+# public_psm_feature_engineering.ipynb, in the order of the model_features columns
+subject_feature_specs = [
+    (['Subject ID'], 'n_subject_stopped'),
+    (['Precinct', 'Subject ID'], 'n_subject_stopped_in_precinct'),
+    (['Precinct', 'Subject Perceived Race'], 'n_race_stopped_in_precinct'),
+    (['Precinct'], 'n_stops_in_precinct'),
+    (['Officer ID', 'Subject Perceived Race'], 'n_race_stopped_by_officer'),
+    (['Officer ID'], 'n_stops_by_officer'),
+    (['Officer ID', 'Subject ID'], 'n_subject_stopped_by_officer'),
+    (['Officer ID', 'Frisk Flag', 'Subject ID'], 'n_subject_stopped_officer_frisk'),
+]
+
+# features counted over stops with a weapon involved only
+weapon_feature_specs = [
+    (['Precinct', 'Subject ID'], 'n_subject_stopped_precinct_weapon'),
+    (['Officer ID', 'Subject ID'], 'n_subject_stopped_by_officer_weapon'),
+]
+
+# (percent feature, numerator, denominator), added right after the denominator
+percent_feature_specs = [
+    ('percent_race_stopped_in_precinct', 'n_race_stopped_in_precinct', 'n_stops_in_precinct'),
+    ('percent_race_stopped_by_officer', 'n_race_stopped_by_officer', 'n_stops_by_officer'),
+]
+
+
+def sort_subject_features (subject_feature_df):
+    """Sorts stops by time, breaking ties on Terry Stop ID, so the rolling counts
+    do not depend on the order the stops were loaded in."""
+    return subject_feature_df.sort_values(
+        ['observation_datetime_d', 'Terry Stop ID'], kind='mergesort')
+
+def build_subject_features (subject_feature_df, lookback_periods=lookback_periods):
+    """Computes every rolling count and percent feature of the feature engineering
+    notebook for subject_feature_df (the cols_for_subject_features columns, one row
+    per Terry Stop ID). Weapon features are NaN for stops without a weapon, as
+    after the notebook's left merge. Returns the frame sorted by time."""
+    subject_feature_df = sort_subject_features(subject_feature_df[cols_for_subject_features].copy())
+    for group_by_key, feature_name in subject_feature_specs:
+        subject_feature_df = generate_multi_window_features(
+            subject_feature_df, group_by_key, feature_name, lookback_periods)
+        for percent_name, numerator, denominator in percent_feature_specs:
+            if denominator != feature_name:
+                continue
+            for period in lookback_periods:
+                subject_feature_df[f'{percent_name}_{period}'] = \
+                    subject_feature_df[f'{numerator}_{period}']/subject_feature_df[f'{denominator}_{period}']
+
+    weapon_df = subject_feature_df.loc[subject_feature_df['weapon_type'] == 1, cols_for_subject_features].copy()
+    feature_set = []
+    for group_by_key, feature_name in weapon_feature_specs:
+        weapon_df = generate_multi_window_features(weapon_df, group_by_key, feature_name, lookback_periods)
+        feature_set += [f'{feature_name}_{period}' for period in lookback_periods]
+    subject_feature_df = subject_feature_df.join(weapon_df[feature_set])
+    return subject_feature_df
+
+
+def add_subject_features (stops_df, subject_features):
+    """Merges the output of build_subject_features (or incremental_feature_state.update)
+    onto the stop-level rows, then fills the nulls of rows with a Subject ID with 0,
+    as the feature engineering notebook does before writing model_features."""
+    stops_df = stops_df.merge(subject_features, on=cols_for_subject_features, how='left')
+    has_subject = stops_df['Subject ID'].notnull()
+    stops_df.loc[has_subject] = stops_df.loc[has_subject].fillna(0)
+    return stops_df
+
+
+class incremental_feature_state():
+    """Persisted window state for append-only Terry Stops feature engineering.
+
+    The state keeps the subject-level rows of every stop that can still fall in
+    a lookback window (the longest lookback period before the high-water mark),
+    which covers the recent stops of every Subject ID, Officer ID, Precinct and
+    race key. New stops are computed against this state only, so a nightly run
+    touches the latest days instead of the whole Terry_Stops.csv history and
+    gets the same features as build_subject_features over the full history.
+
+    Only stops after the high-water mark are processed; stops at or before it
+    are treated as already processed. Late-arriving stops need a full rebuild.
+
+    Usage:
+    state = incremental_feature_state("feature_state")
+    if state.load():
+        new_features = state.update(new_stops[cols_for_subject_features])
+    else:
+        features = build_subject_features(full_df[cols_for_subject_features])
+        state.seed(full_df[cols_for_subject_features])
+    state.save()
+    """
+    time_field = 'observation_datetime_d'
+
+    def __init__(self, state_dir, lookback_periods=lookback_periods):
+        self.state_dir = state_dir
+        self.lookback_periods = list(lookback_periods)
+        self.max_window = max(pd.Timedelta(lookback_to_time_period(period))
+                              for period in self.lookback_periods)
+        self.high_water_mark = None
+        self.window_rows = pd.DataFrame(columns=cols_for_subject_features)
+
+    def _paths(self):
+        return (os.path.join(self.state_dir, 'window_rows.pkl'),
+                os.path.join(self.state_dir, 'state.json'))
+
+    def load(self):
+        """Loads the persisted state. Returns False if there is none yet."""
+        rows_path, meta_path = self._paths()
+        if not os.path.isfile(meta_path):
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['lookback_periods'] != self.lookback_periods:
+            raise ValueError(
+                f"State was built for lookback periods {meta['lookback_periods']}, not {self.lookback_periods}.")
+        self.high_water_mark = pd.Timestamp(meta['high_water_mark']) if meta['high_water_mark'] else None
+        self.window_rows = pd.read_pickle(rows_path)
+        return True
+
+    def save(self):
+        """Writes the state to state_dir."""
+        os.makedirs(self.state_dir, exist_ok=True)
+        rows_path, meta_path = self._paths()
+        self.window_rows.to_pickle(rows_path)
+        meta = {
+            'high_water_mark': self.high_water_mark.isoformat() if self.high_water_mark is not None else None,
+            'lookback_periods': self.lookback_periods,
+        }
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    def seed(self, subject_feature_df):
+        """Starts the state from the stops of a full rebuild (build_subject_features
+        over the whole history) without computing their features again."""
+        rows = subject_feature_df[cols_for_subject_features]
+        if rows.empty:
+            return
+        self.high_water_mark = rows[self.time_field].max()
+        recent = rows[rows[self.time_field] >= self.high_water_mark - self.max_window]
+        self.window_rows = sort_subject_features(recent).reset_index(drop=True)
+
+    def update(self, subject_feature_df):
+        """Computes the features for the stops in subject_feature_df that are newer
+        than the high-water mark, then moves the high-water mark and the window
+        forward. Returns the new stops with their features, in the same format
+        as build_subject_features."""
+        if self.high_water_mark is not None:
+            subject_feature_df = subject_feature_df[subject_feature_df[self.time_field] > self.high_water_mark]
+        new_rows = subject_feature_df[cols_for_subject_features]
+        if new_rows.empty:
+            return build_subject_features(new_rows, self.lookback_periods)
+
+        frames = [new_rows.assign(_is_new=True)]
+        if not self.window_rows.empty:
+            # an empty state frame would turn every column into object dtype
+            frames.insert(0, self.window_rows.assign(_is_new=False))
+        combined = pd.concat(frames)
+        # keep the caller's index for the new rows, the old rows get their own
+        index = np.concatenate([np.full(len(self.window_rows), -1), np.arange(len(new_rows))])
+        combined.index = pd.RangeIndex(len(combined))
+        is_new = combined.pop('_is_new').to_numpy(dtype=bool)
+
+        features = build_subject_features(combined, self.lookback_periods)
+        new_features = features[is_new[features.index]]
+        new_features.index = new_rows.index[index[new_features.index]]
+
+        self.high_water_mark = combined[self.time_field].max()
+        recent = combined[combined[self.time_field] >= self.high_water_mark - self.max_window]
+        self.window_rows = sort_subject_features(recent).reset_index(drop=True)
+        return new_features
@@ -0,0 +1,300 @@
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import xgboost as xgb
+
+from public_acn_psm import _iterate_cells, xgb_psm
+from public_psm_estimation import compute_weights, weighted_difference
+
+result_columns = ["experiment", "estimate", "n_replicates", "se", "ci_lower", "ci_upper",
+                  "p_value", "stopped_early"]
+
+# memory-mapped experiment arrays of a pool worker, keyed by experiment
+# directory, so every replicate of an experiment reuses the same mapping
+_worker_experiments = {}
+
+
+def _save_experiment(path, X_processed, label, outcome):
+    """Writes the processed feature matrix, labels and outcome of one experiment
+    as .npy files that workers can memory-map."""
+    os.makedirs(path, exist_ok=True)
+    if sp.issparse(X_processed):
+        X_processed = X_processed.tocsr()
+        np.save(os.path.join(path, "X_data.npy"), X_processed.data)
+        np.save(os.path.join(path, "X_indices.npy"), X_processed.indices)
+        np.save(os.path.join(path, "X_indptr.npy"), X_processed.indptr)
+        np.save(os.path.join(path, "X_shape.npy"), np.asarray(X_processed.shape))
+    else:
+        np.save(os.path.join(path, "X.npy"), np.ascontiguousarray(X_processed))
+    np.save(os.path.join(path, "label.npy"), label)
+    np.save(os.path.join(path, "outcome.npy"), outcome)
+
+
+def _load_experiment(path):
+    """Memory-maps the arrays written by _save_experiment. Pages are shared
+    through the OS page cache, so workers do not each hold a copy."""
+    if path not in _worker_experiments:
+        if os.path.isfile(os.path.join(path, "X.npy")):
+            X = np.load(os.path.join(path, "X.npy"), mmap_mode="r")
+        else:
+            X = sp.csr_matrix(
+                (np.load(os.path.join(path, "X_data.npy"), mmap_mode="r"),
+                 np.load(os.path.join(path, "X_indices.npy"), mmap_mode="r"),
+                 np.load(os.path.join(path, "X_indptr.npy"), mmap_mode="r")),
+                shape=tuple(np.load(os.path.join(path, "X_shape.npy"))), copy=False)
+        _worker_experiments[path] = (X,
+                                     np.load(os.path.join(path, "label.npy")),
+                                     np.load(os.path.join(path, "outcome.npy")))
+    return _worker_experiments[path]
+
+
+def _run_replicate(path, kind, seed, xgb_params, weight_options):
+    """Refits the propensity model on one bootstrap or permutation replicate of
+    an experiment and returns the replicate's weighted difference.
+
+    bootstrap: rows are resampled with replacement within each label, so
+               both groups keep their size.
+    permutation: the labels are shuffled across rows (the null hypothesis of
+                 no difference between the groups).
+    """
+    X, label, outcome = _load_experiment(path)
+    rng = np.random.default_rng(seed)
+    if kind == "bootstrap":
+        rows = np.concatenate([rng.choice(np.flatnonzero(label == value),
+                                          size=int((label == value).sum()))
+                               for value in (0, 1)])
+        rows.sort()
+        X_rep, label_rep, outcome_rep = X[rows], label[rows], outcome[rows]
+    else:
+        X_rep, label_rep, outcome_rep = X, rng.permutation(label), outcome
+    xgb_cl = xgb.XGBClassifier(**xgb_params)
+    xgb_cl.fit(X_rep, label_rep)
+    probability_1 = xgb_cl.predict_proba(X_rep)[:, -1]
+    weights = compute_weights(probability_1, label_rep, **weight_options)
+    return weighted_difference(outcome_rep, label_rep, weights)["difference"]
+
+
+class psm_resampling():
+    """Bootstrap or permutation inference for xgb_psm experiments.
+
+    The weighted difference of an experiment only reflects one fit of the
+    propensity model. Every replicate here refits the classifier (same
+    hyperparameters and number of rounds as the experiment's fitted model)
+    on resampled rows, so the confidence intervals and p-values include the
+    uncertainty of the propensity scores. The fitted sklearn processor is
+    kept as is; only the classifier is refit.
+
+    Replicates run in a process pool. The processed feature matrix of every
+    experiment is written once to work_dir as .npy files and memory-mapped by
+    the workers instead of being pickled with every replicate. Replicates are
+    scheduled round-robin across the experiments, so when the replicate
+    budget or the time limit is reached every experiment has about the same
+    number of replicates.
+
+    key variables:
+    self.experiments: list of added experiments
+    self.results: dataframe with one row per experiment after run()
+
+    Usage:
+    resampler = psm_resampling(kind="bootstrap", n_replicates=200, time_limit=3600)
+    evaluator.just_send_it(month_df, ...)
+    resampler.add_experiment("NORTH-2021-5", evaluator)
+    results = resampler.run()
+    """
+    def __init__(self, kind="bootstrap", n_replicates=200, replicate_budget=None,
+                 time_limit=None, n_workers=None, xgb_threads=1, n_estimators=None,
+                 method="att", trim=None, clip=None, stabilized=False, alpha=0.05,
+                 random_state=0, work_dir=None):
+        """
+        kind: "bootstrap" (confidence intervals and a bootstrap p-value) or
+              "permutation" (p-value of the null of no difference)
+        n_replicates: replicates per experiment
+        replicate_budget: total replicates across all experiments, None for
+                          n_replicates per experiment
+        time_limit: seconds after which no new replicate is started
+        n_workers: worker processes, defaults to the cpu count
+        xgb_threads: XGBoost threads per replicate fit
+        n_estimators: boosting rounds per replicate. None uses the rounds of
+                      each experiment's fitted model.
+        method, trim, clip, stabilized: weighting options, see
+                      public_psm_estimation.compute_weights. They should match
+                      the ones used for the experiment's estimate.
+        alpha: confidence intervals cover 1 - alpha
+        random_state: seed of the replicates; results do not depend on the
+                      number of workers
+        work_dir: directory for the memory-mapped arrays. None uses a
+                  temporary directory that is removed after run().
+        """
+        if kind not in ("bootstrap", "permutation"):
+            raise ValueError(f"Resampling kind {kind} not supported. Supported kinds are bootstrap, permutation.")
+        self.kind = kind
+        self.n_replicates = n_replicates
+        self.replicate_budget = replicate_budget
+        self.time_limit = time_limit
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.xgb_threads = xgb_threads
+        self.n_estimators = n_estimators
+        self.weight_options = {"method": method, "trim": trim, "clip": clip,
+                               "stabilized": stabilized}
+        self.alpha = alpha
+        self.random_state = random_state
+        self.keep_work_dir = work_dir is not None
+        self.work_dir = work_dir if work_dir is not None else tempfile.mkdtemp(prefix="psm_resampling-")
+        self.experiments = []
+        self.results = None
+
+    def add_experiment(self, name, evaluator, label_col="label", outcome_col="Frisk Flag"):
+        """Adds a fitted xgb_psm experiment (after just_send_it or the steps up
+        to generate_weights). The outcome is mapped Y -> 1 and N -> 0 as in
+        absolute_difference."""
+        label = np.asarray(evaluator.evaluated_data[label_col], dtype=np.int64)
+        # Frisk Flag is a categorical when read from the model_features table
+        outcome = evaluator.evaluated_data[outcome_col].astype(object).map({'Y': 1, 'N': 0})
+        outcome = np.asarray(outcome, dtype=float)
+
+        xgb_params = {key: value for key, value in evaluator.xgb_cl.get_params().items()
+                      if key not in ("early_stopping_rounds", "callbacks")}
+        xgb_params["n_estimators"] = (self.n_estimators or
+                                      evaluator.xgb_cl.get_booster().num_boosted_rounds())
+        xgb_params["n_jobs"] = self.xgb_threads
+
+        path = os.path.join(self.work_dir, f"experiment-{len(self.experiments):05d}")
+        _save_experiment(path, evaluator.X_processed, label, outcome)
+        weights = compute_weights(evaluator.evaluated_data['probability_1'].values, label,
+                                  **self.weight_options)
+        self.experiments.append({
+            "name": name,
+            "path": path,
+            "xgb_params": xgb_params,
+            "estimate": weighted_difference(outcome, label, weights)["difference"],
+            # a replicate needs both labels to fit the classifier
+            "resamplable": len(np.unique(label)) == 2,
+        })
+
+    def _replicate_seed(self, experiment, replicate):
+        return np.random.SeedSequence([self.random_state, experiment, replicate])
+
+    def _tasks(self):
+        """Yields (experiment, replicate) pairs round-robin across experiments,
+        up to n_replicates each and replicate_budget in total."""
+        indexes = [i for i, experiment in enumerate(self.experiments) if experiment["resamplable"]]
+        budget = self.replicate_budget
+        for replicate in range(self.n_replicates):
+            for i in indexes:
+                if budget is not None:
+                    if budget <= 0:
+                        return
+                    budget -= 1
+                yield i, replicate
+
+    def run(self):
+        """Runs the replicates and returns a dataframe with one row per
+        experiment:
+        - estimate: the weighted difference of the experiment's own fit
+        - n_replicates: replicates that finished
+        - bootstrap: se, ci_lower, ci_upper (percentile interval) and p_value
+          (two-sided, share of replicates on the other side of 0)
+        - permutation: p_value, share of replicates at least as far from 0
+          as the estimate, (1 + count) / (1 + n_replicates)
+        - stopped_early: True if the time limit ended the run
+        """
+        start = time.time()
+        differences = {i: {} for i in range(len(self.experiments))}
+        stopped_early = False
+        tasks = self._tasks()
+        try:
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                pending = {}
+                while True:
+                    # keep a couple of replicates queued per worker so the
+                    # time limit is checked before every new submission
+                    while len(pending) < 2 * self.n_workers and not stopped_early:
+                        if self.time_limit is not None and time.time() - start > self.time_limit:
+                            print(f"Time limit of {self.time_limit}s reached, no new replicates are started.")
+                            stopped_early = True
+                            break
+                        task = next(tasks, None)
+                        if task is None:
+                            break
+                        i, replicate = task
+                        experiment = self.experiments[i]
+                        future = executor.submit(_run_replicate, experiment["path"], self.kind,
+                                                 self._replicate_seed(i, replicate),
+                                                 experiment["xgb_params"], self.weight_options)
+                        pending[future] = task
+                    if not pending:
+                        break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        i, replicate = pending.pop(future)
+                        differences[i][replicate] = future.result()
+        finally:
+            if not self.keep_work_dir:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+
+        rows = []
+        for i, experiment in enumerate(self.experiments):
+            # replicate order, so the summary does not depend on finishing order
+            replicates = np.array([differences[i][r] for r in sorted(differences[i])], dtype=float)
+            row = {"experiment": experiment["name"], "estimate": experiment["estimate"]}
+            row.update(self.summarize(experiment["estimate"], replicates))
+            row["stopped_early"] = stopped_early
+            rows.append(row)
+        self.results = pd.DataFrame(rows, columns=result_columns)
+        self.run_seconds = time.time() - start
+        return self.results
+
+    def summarize(self, estimate, replicates):
+        """Confidence interval and p-value of one experiment from its replicate
+        differences. Replicates with an undefined difference are left out."""
+        replicates = replicates[~np.isnan(replicates)]
+        n = len(replicates)
+        row = {"n_replicates": n, "se": np.nan, "ci_lower": np.nan,
+               "ci_upper": np.nan, "p_value": np.nan}
+        if n == 0 or np.isnan(estimate):
+            return row
+        if self.kind == "bootstrap":
+            row["se"] = replicates.std(ddof=1) if n > 1 else np.nan
+            row["ci_lower"], row["ci_upper"] = np.quantile(
+                replicates, [self.alpha / 2, 1 - self.alpha / 2])
+            row["p_value"] = min(1.0, 2 * min((replicates <= 0).mean(), (replicates >= 0).mean()))
+        else:
+            row["p_value"] = (1 + (np.abs(replicates) >= abs(estimate)).sum()) / (1 + n)
+        return row
+
+
+def resample_all_stops(df, resampler, training_policy=None, model_cache=None, sparse=False):
+    """Fits xgb_psm for every precinct/year/month cell of df with more than 10
+    records (the cells of evaluate_all_stops), adds each to resampler and
+    runs it. Returns the resampler results with the cell's precinct, year and
+    month.
+
+    Example:
+    resampler = psm_resampling(n_replicates=200, replicate_budget=20000, time_limit=4*3600)
+    inference = resample_all_stops(df, resampler)
+    """
+    drop_cols = ['Subject Perceived Race', 'GO / SC Num', 'Terry Stop ID', 'Subject ID']
+    cells = []
+    for month_df in _iterate_cells(df):
+        if len(month_df) <= 10:
+            continue
+        evaluator = xgb_psm(verbosity=0, model_cache=model_cache,
+                            training_policy=training_policy, sparse=sparse)
+        evaluator.just_send_it(month_df, control_col='Subject Perceived Race',
+                               control_val='White', drop_cols=list(drop_cols),
+                               label_col='label')
+        cell = (month_df.precinct.iloc[0], month_df.observation_year_d.iloc[0],
+                month_df.observation_month_d.iloc[0])
+        resampler.add_experiment(f"{cell[0]}-{cell[1]}-{cell[2]}", evaluator)
+        cells.append(cell)
+    results = resampler.run()
+    results.insert(1, "precinct", [cell[0] for cell in cells])
+    results.insert(2, "observation_year_d", [cell[1] for cell in cells])
+    results.insert(3, "observation_month_d", [cell[2] for cell in cells])
+    return results
@@ -0,0 +1,143 @@
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, rss_bytes is left out there
+    resource = None
+
+# stages of xgb_psm.just_send_it, in execution order
+psm_stages = ["labeling", "pipeline_build", "process_X_y", "fit", "predict", "weighting"]
+# added around the pipeline_build and fit stages when a model cache is used
+psm_cache_stages = ["cache_lookup", "cache_store"]
+
+
+def max_rss_bytes():
+    """High-water mark of the resident set size of this process, or None."""
+    if resource is None:
+        return None
+    # kilobytes on Linux, bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class psm_jsonl_sink():
+    """Appends every stage record to a JSON lines file.
+
+    Usage:
+    instrumentation = psm_instrumentation(sinks=[psm_jsonl_sink("psm_stages.jsonl")])
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, record):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+class psm_instrumentation():
+    """Per-stage timing and memory records for xgb_psm.
+
+    Every stage of an experiment (see psm_stages) produces one record with its
+    wall and CPU seconds, the peak memory allocated during the stage (traced
+    by tracemalloc, which covers Python and NumPy but not XGBoost's native
+    buffers), the process max RSS after the stage, and the row counts and
+    matrix shapes the stage worked on. Records are kept in self.records and
+    passed to every sink, a callable taking the record dict (e.g. a
+    psm_jsonl_sink or a metrics client callback).
+
+    key variables:
+    self.records: stage records of the current experiment
+    self.context: fields added to every record, e.g. precinct, year, month
+
+    Usage:
+    instrumentation = psm_instrumentation(sinks=[psm_jsonl_sink("psm_stages.jsonl")])
+    evaluator = xgb_psm(instrumentation=instrumentation)
+    evaluator.just_send_it(...)
+    instrumentation.summary_columns()
+
+    With evaluate_all_stops, every cell is instrumented in the process that
+    runs it and the records are sent to the sinks by the calling process,
+    so sinks also work with n_workers > 1.
+    """
+    def __init__(self, sinks=None, track_memory=True, context=None):
+        """
+        sinks: list of callables each stage record is passed to
+        track_memory: trace the peak memory of each stage with tracemalloc.
+                      Tracing slows allocation heavy stages down a little.
+        context: dict of fields added to every record
+        """
+        self.sinks = list(sinks or [])
+        self.track_memory = track_memory
+        self.context = dict(context or {})
+        self.records = []
+
+    def reset(self, context=None):
+        """Starts a new experiment: clears the records and sets the context."""
+        self.records = []
+        if context is not None:
+            self.context = dict(context)
+
+    @contextmanager
+    def stage(self, name, **info):
+        """Measures the block as stage name. The yielded dict can be filled
+        with shapes and counts known only at the end of the stage."""
+        started_tracing = False
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            else:
+                tracemalloc.reset_peak()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield info
+        finally:
+            record = dict(self.context)
+            record.update({
+                "stage": name,
+                "seconds": time.perf_counter() - start_wall,
+                "cpu_seconds": time.process_time() - start_cpu,
+            })
+            if self.track_memory:
+                record["peak_bytes"] = max(tracemalloc.get_traced_memory()[1] - start_bytes, 0)
+                if started_tracing:
+                    tracemalloc.stop()
+            record["rss_bytes"] = max_rss_bytes()
+            record.update(info)
+            record["timestamp"] = datetime.now().isoformat()
+            self.records.append(record)
+            self.emit(record)
+
+    def emit(self, record):
+        """Passes a record to every sink."""
+        for sink in self.sinks:
+            sink(record)
+
+    def summary_columns(self, records=None):
+        """Flattens the stage records of one experiment into summary columns:
+        <stage>_seconds and <stage>_peak_bytes for every stage, plus the shape
+        of the processed feature matrix."""
+        columns = {}
+        for record in self.records if records is None else records:
+            stage = record["stage"]
+            columns[f"{stage}_seconds"] = columns.get(f"{stage}_seconds", 0.0) + record["seconds"]
+            if "peak_bytes" in record:
+                columns[f"{stage}_peak_bytes"] = max(columns.get(f"{stage}_peak_bytes", 0), record["peak_bytes"])
+            for key in ("processed_rows", "processed_columns", "processed_nnz"):
+                if key in record:
+                    columns[key] = record[key]
+        return columns
+
+
+@contextmanager
+def no_stage(name, **info):
+    """Stand-in for psm_instrumentation.stage when nothing is instrumented."""
+    yield info
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import joblib
+import pandas as pd
+import xgboost as xgb
+
+
+def previous_cell(cell):
+    """The (precinct, year, month) cell of the calendar month before cell."""
+    precinct, year, month = cell
+    year, month = int(year), int(month)
+    if month == 1:
+        return precinct, year - 1, 12
+    return precinct, year, month - 1
+
+
+class psm_model_cache():
+    """Content-addressed cache of fitted PSM models.
+
+    An entry holds the fitted booster and the fitted sklearn processor of one
+    xgb_psm experiment. Entries are keyed by a hash of the cell's input rows,
+    its feature schema and the classifier hyperparameters, so a cell whose
+    data has not changed since the last run is loaded from disk instead of
+    being refit. The cache is bounded by max_entries and/or max_bytes and
+    evicts the least recently used entries first.
+
+    For warm starts the cache also keeps a small pointer file for every
+    (precinct, year, month) cell: the cell's cache key and the key of the
+    base model its chain continues from (see previous_cell). Base models are
+    ordinary entries under models/ and count towards the limits. A pointer
+    whose base entry was evicted is removed by evict(), so the pointers are
+    bounded by the cells of the base models that are still cached.
+
+    Layout:
+    cache_dir/models/<key>/booster.json
+    cache_dir/models/<key>/processor.joblib
+    cache_dir/warm/<precinct>/<year>-<month>.json
+
+    Usage:
+    cache = psm_model_cache("psm_model_cache", max_entries=5000)
+    evaluator = xgb_psm(model_cache=cache)
+    """
+    def __init__(self, cache_dir, max_entries=None, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.join(cache_dir, "models"), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, "warm"), exist_ok=True)
+
+    def make_key(self, X, y, params):
+        """Hashes the input rows, feature schema and hyperparameters into a
+        cache key."""
+        digest = hashlib.sha256()
+        schema = [(str(col), str(dtype)) for col, dtype in X.dtypes.items()]
+        digest.update(json.dumps(schema).encode())
+        digest.update(pd.util.hash_pandas_object(X, index=False).values.tobytes())
+        digest.update(pd.util.hash_pandas_object(y, index=False).values.tobytes())
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, "models", key)
+
+    def _warm_path(self, cell):
+        precinct, year, month = cell
+        return os.path.join(self.cache_dir, "warm", str(precinct),
+                            f"{int(year)}-{int(month):02d}.json")
+
+    def _load(self, path):
+        xgb_cl = xgb.XGBClassifier()
+        xgb_cl.load_model(os.path.join(path, "booster.json"))
+        processor = joblib.load(os.path.join(path, "processor.joblib"))
+        return xgb_cl, processor
+
+    def _save(self, path, xgb_cl, processor, meta=None):
+        """Writes the entry to a temporary directory first and moves it into
+        place, so parallel workers never see a half written entry."""
+        parent = os.path.dirname(path)
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=parent)
+        xgb_cl.save_model(os.path.join(tmp, "booster.json"))
+        joblib.dump(processor, os.path.join(tmp, "processor.joblib"))
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(meta or {}, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            # another worker stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def get(self, key):
+        """Returns (xgb_cl, processor) for key, or None on a cache miss."""
+        path = self._entry_dir(key)
+        if not os.path.isfile(os.path.join(path, "booster.json")):
+            self.misses += 1
+            return None
+        try:
+            entry = self._load(path)
+            # touch the entry so it counts as recently used
+            os.utime(path)
+        except (OSError, ValueError, xgb.core.XGBoostError):
+            # evicted or damaged while loading, treat as a miss
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, xgb_cl, processor):
+        """Stores a fitted classifier and processor under key and evicts old
+        entries if the cache is over its limits."""
+        self._save(self._entry_dir(key), xgb_cl, processor)
+        self.evict()
+
+    def get_warm_start(self, cell):
+        """Returns (xgb_cl, processor, pointer) for the (precinct, year, month)
+        cell: the base model its chain continues from and the cell's pointer
+        (source_key, base_key, age, params), or None if there is no pointer or
+        the base model is no longer cached."""
+        try:
+            with open(self._warm_path(cell)) as f:
+                pointer = json.load(f)
+        except (OSError, ValueError):
+            return None
+        path = self._entry_dir(pointer["base_key"])
+        try:
+            xgb_cl, processor = self._load(path)
+            os.utime(path)
+        except (OSError, ValueError, xgb.core.XGBoostError):
+            return None
+        return xgb_cl, processor, pointer
+
+    def put_warm_start(self, cell, pointer):
+        """Stores the warm start pointer of the (precinct, year, month) cell."""
+        path = self._warm_path(cell)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(path))
+        with os.fdopen(fd, "w") as f:
+            json.dump(pointer, f)
+        os.replace(tmp, path)
+
+    def _prune_warm_starts(self, removed_keys):
+        """Removes the pointers whose base model was evicted."""
+        warm_dir = os.path.join(self.cache_dir, "warm")
+        for root, _, files in os.walk(warm_dir):
+            for name in files:
+                if name.startswith(".") or not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    with open(path) as f:
+                        base_key = json.load(f).get("base_key")
+                    if base_key in removed_keys:
+                        os.remove(path)
+                except (OSError, ValueError):
+                    continue
+
+    def _entries(self):
+        """Lists (mtime, size, path) for every model entry."""
+        entries = []
+        models_dir = os.path.join(self.cache_dir, "models")
+        for name in os.listdir(models_dir):
+            if name.startswith("."):
+                continue
+            path = os.path.join(models_dir, name)
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                entries.append((os.stat(path).st_mtime, size, path))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        """Removes least recently used entries until the cache is within
+        max_entries and max_bytes."""
+        if self.max_entries is None and self.max_bytes is None:
+            return
+        entries = sorted(self._entries())
+        total_bytes = sum(size for _, size, _ in entries)
+        removed_keys = set()
+        while entries and (
+                (self.max_entries is not None and len(entries) > self.max_entries)
+                or (self.max_bytes is not None and total_bytes > self.max_bytes)):
+            _, size, path = entries.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            removed_keys.add(os.path.basename(path))
+            total_bytes -= size
+        if removed_keys:
+            self._prune_warm_starts(removed_keys)
+
+    def clear(self):
+        """Removes every entry, including warm start pointers."""
+        for sub in ("models", "warm"):
+            shutil.rmtree(os.path.join(self.cache_dir, sub), ignore_errors=True)
+            os.makedirs(os.path.join(self.cache_dir, sub), exist_ok=True)
@@ -0,0 +1,143 @@
+import pandas as pd
+import os
+
+from public_psm_storage import apply_schema, read_table, write_table
+
+
+class psm_result_collector():
+    """Collects the per-cell outputs of evaluate_all_stops.
+
+    Summary rows are buffered column by column and propensity frames are kept
+    in a list, so each final dataframe is built exactly once instead of being
+    re-appended after every cell. When output_dir is set, every evaluated cell
+    is also written straight to a part file, which lets long runs (e.g. 10
+    years of all precincts) stream to disk without holding the propensity
+    table in memory.
+
+    key variables:
+    self.summary_columns: dict of column name -> list of values, one per cell
+    self.propensity_parts: list of propensity dataframes kept in memory
+    self.part_files: list of part files written so far
+
+    Usage:
+    collector = psm_result_collector(output_dir="results", output_format="parquet")
+    eval_flag, summaries, propensities = evaluate_all_stops(df, collector=collector)
+
+    A collector holds the results of a single run; create a new one per run.
+    """
+    summary_defaults = ['precinct', 'observation_year_d', 'observation_month_d',
+                        'total_records', 'attempted_to_assess',
+                        'label_0_records_count', 'label_1_records_count']
+
+    def __init__(self, output_dir=None, output_format="parquet",
+                 keep_in_memory=None, columns=None, rename=None, schema=None,
+                 summary_schema=None):
+        """
+        output_dir: directory for streamed part files. None keeps everything
+                    in memory.
+        output_format: "parquet" or "csv".
+        keep_in_memory: keep propensity frames in memory as well as on disk.
+                        Defaults to True without output_dir, False with it.
+        columns: optional list of propensity columns to keep for each cell.
+        rename: optional dict to rename propensity columns for each cell.
+        schema: optional column kinds (see public_psm_storage) the propensity
+                part files are written and read back with, after rename.
+        summary_schema: optional column kinds of the summary file.
+        """
+        if output_format not in ("parquet", "csv"):
+            raise ValueError(
+                f"output_format {output_format} not supported. Supported formats are parquet and csv.")
+        if output_format == "parquet" and output_dir is not None:
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ImportError(
+                    "pyarrow is required to write parquet part files, please install it or use output_format='csv'")
+        self.output_dir = output_dir
+        self.output_format = output_format
+        if keep_in_memory is None:
+            keep_in_memory = output_dir is None
+        self.keep_in_memory = keep_in_memory
+        self.columns = columns
+        self.rename = rename
+        self.schema = schema
+        self.summary_schema = summary_schema
+        self.summary_columns = {col: [] for col in self.summary_defaults}
+        self.n_cells = 0
+        self.propensity_parts = []
+        self.part_files = []
+        if output_dir is not None:
+            os.makedirs(os.path.join(output_dir, "propensities"), exist_ok=True)
+
+    def add_cell(self, row, evaluated_data=None, run_timestamp=None):
+        """Adds one cell's summary row and, if the cell was evaluated, its
+        propensity frame. run_timestamp is stamped on the cell's rows only."""
+        if run_timestamp is not None:
+            row = dict(row, run_timestamp=run_timestamp)
+        for col in row:
+            if col not in self.summary_columns:
+                # backfill columns that first appear in a later cell
+                self.summary_columns[col] = [None] * self.n_cells
+        for col, values in self.summary_columns.items():
+            values.append(row.get(col))
+        self.n_cells += 1
+
+        if evaluated_data is None:
+            return
+        part = evaluated_data
+        if run_timestamp is not None:
+            part = part.assign(run_timestamp=run_timestamp)
+        if self.columns is not None:
+            part = part[self.columns]
+        if self.rename is not None:
+            part = part.rename(columns=self.rename)
+        if self.output_dir is not None:
+            self._write_part(part)
+        if self.keep_in_memory:
+            self.propensity_parts.append(part)
+
+    def _write_part(self, part):
+        """Writes one propensity part file to output_dir/propensities."""
+        path = os.path.join(
+            self.output_dir, "propensities",
+            f"part-{len(self.part_files):05d}.{self.output_format}")
+        if self.output_format == "parquet":
+            write_table(part, path, self.schema)
+        else:
+            apply_schema(part, self.schema).to_csv(path, index=False)
+        self.part_files.append(path)
+
+    def summary_frame(self):
+        """Builds the summary dataframe, one row per cell."""
+        return pd.DataFrame(self.summary_columns)
+
+    def propensity_frame(self):
+        """Builds the propensity dataframe from the in-memory parts. Returns an
+        empty dataframe if nothing was evaluated or parts were only streamed
+        to disk (see read_propensities)."""
+        if not self.propensity_parts:
+            return pd.DataFrame()
+        return pd.concat(self.propensity_parts)
+
+    def write_summary(self):
+        """Writes the summary dataframe to output_dir and returns its path."""
+        if self.output_dir is None:
+            raise ValueError("Collector has no output_dir to write to.")
+        path = os.path.join(self.output_dir,
+                            f"summaries.{self.output_format}")
+        summary = self.summary_frame()
+        if self.output_format == "parquet":
+            write_table(summary, path, self.summary_schema)
+        else:
+            apply_schema(summary, self.summary_schema).to_csv(path, index=False)
+        return path
+
+    def read_propensities(self):
+        """Reads the streamed part files back into a single dataframe."""
+        if self.output_format == "parquet":
+            parts = [read_table(path) for path in self.part_files]
+        else:
+            parts = [pd.read_csv(path) for path in self.part_files]
+        if not parts:
+            return pd.DataFrame()
+        return apply_schema(pd.concat(parts, ignore_index=True), self.schema)
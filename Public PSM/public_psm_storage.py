@@ -0,0 +1,272 @@
+import json
+import os
+import shutil
+import uuid
+
+import pandas as pd
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+# Column kinds of a schema:
+# category: pandas categorical, stored dictionary encoded
+# str: str values, missing values stay missing
+# str_category: cast to str first (ids read back as numbers), then categorical
+# datetime: datetime64
+# int64: int64, float64 when the column has missing values
+# float64: float64
+# Columns not in the schema keep the dtype they have.
+
+# model_features written by public_psm_feature_engineering and read by public_psm_app
+model_features_schema = {
+    'Subject Age Group': 'category',
+    'Subject ID': 'float64',
+    'GO / SC Num': 'int64',
+    'Terry Stop ID': 'int64',
+    'Stop Resolution': 'category',
+    'Officer ID': 'str_category',
+    'Officer YOB': 'int64',
+    'Officer Gender': 'category',
+    'Officer Race': 'category',
+    'Subject Perceived Race': 'category',
+    'Subject Perceived Gender': 'category',
+    'Initial Call Type': 'category',
+    'Final Call Type': 'category',
+    'Call Type': 'category',
+    'Officer Squad': 'str_category',
+    'Arrest Flag': 'category',
+    'Frisk Flag': 'category',
+    'Precinct': 'category',
+    'Sector': 'category',
+    'Beat': 'category',
+    'weapon_type': 'int64',
+    'weapon_count': 'int64',
+    'observation_datetime_d': 'datetime',
+    'observation_year_d': 'int64',
+    'observation_month_d': 'int64',
+    'observation_day_d': 'int64',
+    'observation_week_d': 'int64',
+    'observation_time_d': 'str',
+    'observation_week_of_month_d': 'int64',
+    'watch_d': 'category',
+    'Precinct_watch_d': 'category',
+}
+# A precinct-month holds a few hundred stops, too few for a file of its own:
+# months are selected by filtering the rows of the precinct-year files
+model_features_partitions = ['Precinct', 'observation_year_d']
+
+# outputs of public_psm_app
+summaries_schema = {
+    'attempted_to_assess': 'category',
+    'run_timestamp': 'datetime',
+}
+propensities_schema = {
+    'watch_d': 'category',
+    'Precinct_watch_d': 'category',
+    'observation_datetime_d': 'datetime',
+    'Officer Race': 'category',
+    'Subject Perceived Race': 'category',
+    'Subject Age Group': 'category',
+    'Frisk Flag': 'category',
+    'subject_race_label_d': 'int64',
+    'subject_race_label_pred': 'int64',
+    'run_timestamp': 'datetime',
+}
+
+# column order of a partitioned table, partition columns are read back last
+_columns_file = '_columns.json'
+
+
+def _require_pyarrow():
+    if pq is None:
+        raise ImportError("pyarrow is required to read and write parquet tables, please install it.")
+
+
+def apply_schema(df, schema):
+    """Casts the columns of df that are in schema to their kind (see above).
+    Columns missing from df are skipped. Returns a new dataframe."""
+    df = df.copy()
+    for col, kind in (schema or {}).items():
+        if col not in df.columns:
+            continue
+        if kind == 'category':
+            df[col] = df[col].astype('category')
+        elif kind == 'str':
+            df[col] = df[col].astype(object).where(df[col].isna(), df[col].astype(str))
+        elif kind == 'str_category':
+            if not isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(str)
+            df[col] = df[col].astype('category')
+        elif kind == 'datetime':
+            df[col] = pd.to_datetime(df[col])
+        elif kind == 'int64':
+            values = df[col].astype(object) if isinstance(df[col].dtype, pd.CategoricalDtype) else df[col]
+            values = pd.to_numeric(values)
+            df[col] = values.astype('float64' if values.isna().any() else 'int64')
+        elif kind == 'float64':
+            values = df[col].astype(object) if isinstance(df[col].dtype, pd.CategoricalDtype) else df[col]
+            df[col] = pd.to_numeric(values).astype('float64')
+        else:
+            raise ValueError(f"unknown column kind {kind} for column {col}")
+    return df
+
+
+def _storage_frame(df):
+    """Categorical columns are written as their values: Parquet dictionary
+    encodes them on disk either way, and the width of pandas' category codes
+    would otherwise differ between the files of a table."""
+    df = df.reset_index(drop=True)
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+    return df
+
+
+def _write_columns(path, columns):
+    with open(os.path.join(path, _columns_file), 'w') as f:
+        json.dump(list(columns), f)
+
+
+def write_table(df, path, schema=None, partition_cols=None, overwrite=True):
+    """Writes df as a Parquet table with the column types of schema.
+
+    Args:
+        df (pandas dataframe): the table to write, the index is not written
+        path (str): a .parquet file, or the root folder of the dataset when
+                    partition_cols is given
+        schema (dict): column kinds, see apply_schema
+        partition_cols (list): write one folder per value, e.g.
+                    path/Precinct=NORTH/observation_year_d=2021/
+        overwrite (bool): remove the whole table first. False only replaces
+                    the partitions present in df, so a single precinct-year
+                    can be rewritten without touching the others.
+
+    Returns:
+        path
+    """
+    _require_pyarrow()
+    df = _storage_frame(apply_schema(df, schema))
+    if not partition_cols:
+        df.to_parquet(path, index=False)
+        return path
+    if overwrite and os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path, exist_ok=True)
+    df.to_parquet(path, index=False, partition_cols=list(partition_cols),
+                  existing_data_behavior='delete_matching')
+    _write_columns(path, df.columns)
+    return path
+
+
+def append_table(df, path, schema=None, partition_cols=None):
+    """Adds the rows of df to a partitioned table written by write_table, e.g.
+    the nightly stops to model_features. The rows are written as new files in
+    the partition folders of their values; the files already there are not
+    read or rewritten. df must have the columns of the table."""
+    _require_pyarrow()
+    if not os.path.isdir(path):
+        return write_table(df, path, schema, partition_cols)
+    df = _storage_frame(apply_schema(df, schema))
+    if os.path.isfile(os.path.join(path, _columns_file)):
+        with open(os.path.join(path, _columns_file)) as f:
+            columns = json.load(f)
+        if sorted(columns) != sorted(df.columns):
+            raise ValueError(f"columns of df do not match the table at {path}")
+        df = df[columns]
+    if df.empty:
+        return path
+    df.to_parquet(path, index=False, partition_cols=list(partition_cols),
+                  existing_data_behavior='overwrite_or_ignore',
+                  basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet')
+    return path
+
+
+def read_table(path, schema=None, columns=None, filters=None):
+    """Reads a table written by write_table or csv_to_table.
+
+    Only the requested columns are read from disk and, for a partitioned
+    table, filters on the partition columns skip the files of every other
+    partition, e.g. filters=[('Precinct', '=', 'NORTH'), ('observation_year_d', '=', 2021)]
+    (see pyarrow.parquet.read_table for the filter syntax). Filters on other
+    columns are applied to the rows of the files that are read. Categorical
+    columns of schema are read straight from the Parquet dictionaries.
+
+    Args:
+        path (str): .parquet file or dataset folder
+        schema (dict): column kinds, partition columns come back as
+                       categories of strings or ints otherwise
+        columns (list): columns to read, None reads all
+        filters (list): pyarrow filters
+
+    Returns:
+        dataframe in the column order it was written with (or of columns)
+    """
+    _require_pyarrow()
+    order = columns
+    if order is None and os.path.isfile(os.path.join(path, _columns_file)):
+        with open(os.path.join(path, _columns_file)) as f:
+            order = json.load(f)
+    dictionaries = [col for col, kind in (schema or {}).items()
+                    if kind in ('category', 'str_category') and (order is None or col in order)]
+    df = pd.read_parquet(path, columns=columns, filters=filters,
+                         read_dictionary=dictionaries or None)
+    if order is not None:
+        df = df[[col for col in order if col in df.columns]]
+    return apply_schema(df, schema)
+
+
+def csv_to_table(csv_path, path, schema=None, partition_cols=None, chunksize=100000,
+                 drop_cols=('Unnamed: 0',)):
+    """Converts a csv (e.g. an existing model_features.csv) to a Parquet table
+    folder at path, reading the csv chunksize rows at a time. drop_cols 
+    removes the index column written by to_csv. Returns the number of rows 
+    written."""
+    _require_pyarrow()
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    n_rows = 0
+    for n, chunk in enumerate(pd.read_csv(csv_path, chunksize=chunksize)):
+        chunk = chunk.drop(columns=[col for col in drop_cols if col in chunk.columns])
+        chunk = _storage_frame(apply_schema(chunk, schema))
+        if n == 0:
+            _write_columns(path, chunk.columns)
+        # a new file name per chunk, so chunks of the same partition add up
+        chunk.to_parquet(path, index=False, partition_cols=list(partition_cols or []),
+                         existing_data_behavior='overwrite_or_ignore',
+                         basename_template=f'part-{n:05d}-{uuid.uuid4().hex}-{{i}}.parquet')
+        n_rows += len(chunk)
+    return n_rows
+
+
+def load_model_features(path='model_features', csv_path='model_features.csv',
+                        precinct=None, year=None, month=None, columns=None):
+    """Loads the model features for evaluate_all_stops with the types of
+    model_features_schema.
+
+    Reads the partitioned Parquet table at path when it exists, only reading
+    the files of the requested precinct/year and keeping the rows of month. Otherwise falls back to
+    the csv written by earlier versions of the feature engineering notebook.
+
+    Usage:
+    df = load_model_features(precinct='NORTH', year=2021, month=5)
+    df['precinct'] = df['Precinct']
+    eval_flag, summaries, propensities = public_acn_psm.evaluate_all_stops(df)
+    """
+    selection = [('Precinct', precinct), ('observation_year_d', year), ('observation_month_d', month)]
+    if os.path.isdir(path):
+        filters = [(col, '=', value) for col, value in selection if value is not None]
+        return read_table(path, model_features_schema, columns=columns, filters=filters or None)
+    usecols = None
+    if columns is not None:
+        usecols = list(columns) + [col for col, value in selection if value is not None and col not in columns]
+    df = pd.read_csv(csv_path, usecols=usecols)
+    df = apply_schema(df.drop(columns=['Unnamed: 0'], errors='ignore'), model_features_schema)
+    for col, value in selection:
+        if value is not None:
+            df = df[df[col] == value]
+    if columns is not None:
+        df = df[list(columns)]
+    return df.reset_index(drop=True)
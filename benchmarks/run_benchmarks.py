@@ -0,0 +1,480 @@
+"""Benchmark suite for the PSM, bias crime and gender disparity pipelines.
+
+Times and memory-profiles the main pipeline steps on synthetic data (see
+synthetic_data.py) at several data sizes and appends one JSON record per
+benchmark and size to a JSON lines file, so runs on different commits or
+machines can be compared:
+
+    python run_benchmarks.py --output benchmark_results.jsonl
+    python run_benchmarks.py --quick --benchmarks psm_just_send_it iptw_engine_run
+    python run_benchmarks.py --compare baseline.jsonl --output current.jsonl
+
+Every case is run once with tracemalloc for its peak Python/NumPy memory
+(which also warms up imports and caches) and then --repeat times for its
+wall time. The maximum resident set size is that of the whole process; use
+--isolate to run every case in its own process so it belongs to that case
+only (and includes XGBoost's native allocations, which tracemalloc does not
+see).
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+import warnings
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import synthetic_data
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, max_rss_bytes is left out there
+    resource = None
+
+benchmarks = {}
+
+
+def benchmark(name, pipeline, unit, sizes, quick_sizes):
+    """Registers a benchmark. The decorated function takes (size, work_dir,
+    seed) and returns the callable that is measured."""
+    def register(setup):
+        benchmarks[name] = {"name": name, "pipeline": pipeline, "unit": unit, "sizes": sizes,
+                            "quick_sizes": quick_sizes, "setup": setup, "doc": (setup.__doc__ or "").strip()}
+        return setup
+    return register
+
+
+def _max_rss_bytes():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return max(rss, children) * scale
+
+
+# ---- PSM
+
+psm_drop_cols = ['Subject Perceived Race', 'GO / SC Num', 'Terry Stop ID', 'Subject ID']
+
+
+@benchmark("psm_just_send_it", "psm", "rows per cell", sizes=[100, 500, 2000], quick_sizes=[100])
+def psm_just_send_it(size, work_dir, seed):
+    """xgb_psm.just_send_it on one precinct/month cell with the default
+    training policy (3000 rounds)."""
+    from public_acn_psm import xgb_psm
+    df = synthetic_data.model_features_as_read(synthetic_data.terry_stops_model_features(
+        size, start="2021-05-01", end="2021-05-31 23:59", precincts=["NORTH"], seed=seed))
+
+    def run():
+        evaluator = xgb_psm(verbosity=0)
+        evaluator.just_send_it(df.copy(), control_col='Subject Perceived Race', control_val='White',
+                               drop_cols=list(psm_drop_cols), label_col='label')
+    return run
+
+
+@benchmark("psm_load_partition", "psm", "stops in table", sizes=[50000, 200000], quick_sizes=[20000])
+def psm_load_partition(size, work_dir, seed):
+    """load_model_features of one precinct/year/month cell from the
+    partitioned Parquet table."""
+    from public_psm_storage import load_model_features, write_table, model_features_schema, \
+        model_features_partitions
+    df = synthetic_data.terry_stops_model_features(size, start="2019-01-01", end="2021-12-31", seed=seed)
+    table_path = os.path.join(work_dir, "model_features")
+    write_table(df, table_path, model_features_schema, model_features_partitions)
+
+    def run():
+        load_model_features(table_path, precinct="NORTH", year=2021, month=5)
+    return run
+
+
+@benchmark("psm_load_csv", "psm", "stops in table", sizes=[50000, 200000], quick_sizes=[20000])
+def psm_load_csv(size, work_dir, seed):
+    """The same cell read from model_features.csv, the storage of the
+    original notebooks."""
+    from public_psm_storage import load_model_features
+    df = synthetic_data.terry_stops_model_features(size, start="2019-01-01", end="2021-12-31", seed=seed)
+    csv_path = os.path.join(work_dir, "model_features.csv")
+    df.to_csv(csv_path)
+
+    def run():
+        load_model_features(os.path.join(work_dir, "missing"), csv_path, precinct="NORTH", year=2021, month=5)
+    return run
+
+
+def _subject_feature_df(size, seed):
+    from public_psm_incremental import cols_for_subject_features, sort_subject_features
+    df = synthetic_data.terry_stops_model_features(size, seed=seed)
+    return sort_subject_features(df[cols_for_subject_features]).reset_index(drop=True)
+
+
+@benchmark("psm_generate_features", "psm", "stops", sizes=[5000, 20000, 50000], quick_sizes=[2000])
+def psm_generate_features(size, work_dir, seed):
+    """generate_features: rolling count of stops per Subject ID for each of
+    the five lookback periods, one call per period as in the original
+    feature engineering notebook."""
+    from public_psm_commonfunctions import generate_features
+    from public_psm_incremental import lookback_periods
+    df = _subject_feature_df(size, seed)
+
+    def run():
+        for period in lookback_periods:
+            generate_features(df, ['Subject ID'], 'n_subject_stopped', period)
+    return run
+
+
+@benchmark("psm_multi_window_features", "psm", "stops", sizes=[10000, 200000, 1000000], quick_sizes=[5000, 20000])
+def psm_multi_window_features(size, work_dir, seed):
+    """generate_multi_window_features: the same five Subject ID counts in one
+    sorted pass."""
+    from public_psm_commonfunctions import generate_multi_window_features
+    from public_psm_incremental import lookback_periods
+    df = _subject_feature_df(size, seed)
+
+    def run():
+        generate_multi_window_features(df, ['Subject ID'], 'n_subject_stopped', lookback_periods)
+    return run
+
+
+@benchmark("psm_build_subject_features", "psm", "stops", sizes=[10000, 200000, 1000000], quick_sizes=[5000, 20000])
+def psm_build_subject_features(size, work_dir, seed):
+    """build_subject_features: every rolling count and percent feature of the
+    feature engineering notebook."""
+    from public_psm_incremental import build_subject_features
+    df = synthetic_data.terry_stops_model_features(size, seed=seed)
+
+    def run():
+        build_subject_features(df)
+    return run
+
+
+# ---- Bias crimes
+
+def _nlp_module():
+    """The NLP module, or None if its NLTK resources are not installed."""
+    import bias_crimes_NLP_preprocessing_common_functions as nlp
+    return nlp if not nlp.missingResources() else None
+
+
+class _skip(Exception):
+    pass
+
+
+@benchmark("nlp_preprocess_functions", "bias_crimes", "narratives", sizes=[100, 500], quick_sizes=[20])
+def nlp_preprocess_functions(size, work_dir, seed):
+    """removeStopWords, removeFeatures and lemmatize applied per narrative, as
+    in the feature engineering notebooks."""
+    nlp = _nlp_module()
+    if nlp is None:
+        raise _skip("NLTK resources are missing, see provisionResources()")
+    texts = synthetic_data.narratives(size, seed=seed)['narrative']
+
+    def run():
+        texts.apply(nlp.removeStopWords).apply(nlp.removeFeatures).apply(nlp.lemmatize)
+    return run
+
+
+@benchmark("nlp_preprocess_batch", "bias_crimes", "narratives", sizes=[100, 1000, 5000], quick_sizes=[20, 100])
+def nlp_preprocess_batch(size, work_dir, seed):
+    """narrative_preprocessor.preprocessBatch in one process."""
+    nlp = _nlp_module()
+    if nlp is None:
+        raise _skip("NLTK resources are missing, see provisionResources()")
+    texts = synthetic_data.narratives(size, seed=seed)['narrative'].tolist()
+    preprocessor = nlp.narrative_preprocessor()
+
+    def run():
+        preprocessor.preprocessBatch(texts)
+    return run
+
+
+@benchmark("nlp_preprocess_file", "bias_crimes", "narratives", sizes=[1000, 10000], quick_sizes=[200])
+def nlp_preprocess_file(size, work_dir, seed):
+    """preprocessNarrativeFile from a narratives.csv to a corpus csv with a
+    process pool of every cpu. Memory is that of the parent process."""
+    nlp = _nlp_module()
+    if nlp is None:
+        raise _skip("NLTK resources are missing, see provisionResources()")
+    input_path = os.path.join(work_dir, "narratives.csv")
+    synthetic_data.narratives(size, seed=seed).to_csv(input_path, index=False)
+    output_path = os.path.join(work_dir, "corpus.csv")
+
+    def run():
+        nlp.preprocessNarrativeFile(input_path, output_path, chunksize=200)
+    return run
+
+
+@benchmark("bias_rank_flatten", "bias_crimes", "reports", sizes=[1000, 10000, 100000], quick_sizes=[1000, 5000])
+def bias_rank_flatten(size, work_dir, seed):
+    """rankDemographics and flattenReports on incident_offense rows, the
+    report flattening of the inference feature engineering."""
+    from bias_crimes_feature_engineering_common_functions import flattenReports, offenseRank, rankDemographics
+    df = synthetic_data.incident_offense(size, seed=seed)
+
+    def run():
+        ranked = df.assign(offense_rank=offenseRank(df['crime_description']))
+        flattenReports(rankDemographics(ranked))
+    return run
+
+
+def _scoring_artifacts(work_dir, seed):
+    """Writes a small model, count vectorizer and threshold with the layout
+    the scorer loads. Returns their paths and the number of features."""
+    import joblib
+    import xgboost as xgb
+    from bias_crimes_scoring import report_feature_names
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    cv = CountVectorizer()
+    cv.fit(synthetic_data.narratives(50, seed=seed)['narrative'])
+    n_features = len(cv.get_feature_names_out()) + len(report_feature_names)
+    rng = np.random.default_rng(seed)
+    X = rng.poisson(0.5, (2000, n_features)).astype(np.float32)
+    y = (X[:, 0] + rng.random(2000) > 1).astype(int)
+    model = xgb.XGBClassifier(n_estimators=200, max_depth=6, learning_rate=0.1, n_jobs=1)
+    model.fit(X, y)
+
+    paths = {"model_path": os.path.join(work_dir, "xgboost_model.json"),
+             "vectorizer_path": os.path.join(work_dir, "countvectorizer.pkl"),
+             "threshold_path": os.path.join(work_dir, "optimal_threshold.csv")}
+    model.get_booster().save_model(paths["model_path"])
+    joblib.dump(cv, paths["vectorizer_path"])
+    np.savetxt(paths["threshold_path"], [0.5])
+    return paths, n_features
+
+
+@benchmark("bias_scoring", "bias_crimes", "reports", sizes=[1000, 10000, 100000], quick_sizes=[1000, 5000])
+def bias_scoring(size, work_dir, seed):
+    """bias_crime_scorer.scoreFile from inference_features.csv and
+    inference_reports.csv files to pos_preds.csv, artifacts already loaded."""
+    from bias_crimes_scoring import bias_crime_scorer
+    paths, n_features = _scoring_artifacts(work_dir, seed)
+    rng = np.random.default_rng(seed)
+    features_path = os.path.join(work_dir, "inference_features.csv")
+    reports_path = os.path.join(work_dir, "inference_reports.csv")
+    pd.DataFrame(rng.poisson(0.5, (size, n_features))).to_csv(features_path, header=False, index=False)
+    pd.DataFrame({"report_id": 100000 + np.arange(size),
+                  "reporting_event_number": 65100000000 + np.arange(size) * 37}).to_csv(reports_path, index=False)
+    scorer = bias_crime_scorer(**paths)
+    output_path = os.path.join(work_dir, "pos_preds.csv")
+
+    def run():
+        scorer.scoreFile(features_path, reports_path, output_path)
+    return run
+
+
+# ---- Gender disparity
+
+race_covariates = ['American Indian/Alaska Native', 'Asian', 'Black or African American', 'Hispanic or Latino',
+                   'Nat Hawaiian/Oth Pac Islander', 'Two or More Races', 'Unknown', 'White']
+
+# the four (outcome, covariates) sections of IPTW_Disparity_Code_Github.ipynb
+iptw_specs = [(['Complaints Count'], ['Cad Count', 'Dollars Earned (Gross)', 'Io Report Count', 'Highest Rank',
+                                      'Certifications Count', 'Unit Count', 'Military Experience', 'Hours Worked',
+                                      'Max. Comp. Rate', 'Promotion Count'] + race_covariates + ['Last Pay Year', 'Year of Birth']),
+              (['Dollars Earned (Gross)'], ['Cad Count', 'Complaints Count Sus', 'Io Report Count', 'Highest Rank',
+                                            'Certifications Count', 'Unit Count', 'Military Experience', 'Hours Worked',
+                                            'Max. Comp. Rate', 'Promotion Count'] + race_covariates + ['Last Pay Year', 'Year of Birth']),
+              (['Promotion Count'], ['Cad Count', 'Complaints Count Sus', 'Io Report Count', 'Highest Rank',
+                                     'Certifications Count', 'Unit Count', 'Military Experience', 'Hours Worked',
+                                     'Max. Comp. Rate', 'Dollars Earned (Gross)'] + race_covariates + ['Last Pay Year', 'Year of Birth']),
+              (['Highest Rank'], ['Cad Count', 'Complaints Count Sus', 'Io Report Count', 'Promotion Count',
+                                  'Certifications Count', 'Unit Count', 'Military Experience', 'Hours Worked',
+                                  'Max. Comp. Rate', 'Dollars Earned (Gross)'] + race_covariates + ['Last Pay Year', 'Year of Birth'])]
+
+
+@benchmark("iptw_engine_run", "gender_disparity", "employees", sizes=[2000, 20000, 200000], quick_sizes=[2000, 10000])
+def iptw_engine_run(size, work_dir, seed):
+    """iptw_engine.run of the notebook's four outcomes with Crump trimming,
+    fitting every propensity model."""
+    from iptw_disparity_functions import iptw_engine
+    df = synthetic_data.disparity_data(size, seed=seed)
+
+    def run():
+        iptw_engine(df, 'gender_binary').run(iptw_specs, trim='crump')
+    return run
+
+
+# ---- Runner
+
+def _environment():
+    versions = {}
+    for module in ("numpy", "pandas", "sklearn", "xgboost", "scipy", "nltk"):
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            versions[module] = None
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=synthetic_data.repo_dir,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"git_commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+            "machine": platform.machine(), "cpu_count": os.cpu_count(), "versions": versions}
+
+
+def run_case(spec, size, repeat, seed):
+    """Measures one benchmark at one size and returns its record."""
+    record = {"benchmark": spec["name"], "pipeline": spec["pipeline"], "size": size, "unit": spec["unit"],
+              "repeat": repeat, "seed": seed}
+    work_dir = tempfile.mkdtemp(prefix=f"bench-{spec['name']}-")
+    try:
+        start = time.perf_counter()
+        fn = spec["setup"](size, work_dir, seed)
+        record["setup_seconds"] = time.perf_counter() - start
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        fn()
+        record["traced_run_seconds"] = time.perf_counter() - start
+        record["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            seconds.append(time.perf_counter() - start)
+        record.update({"status": "ok", "seconds": seconds, "min_seconds": min(seconds),
+                       "median_seconds": float(np.median(seconds)), "mean_seconds": float(np.mean(seconds)),
+                       "per_second": size / float(np.median(seconds)) if np.median(seconds) > 0 else None})
+    except _skip as e:
+        record.update({"status": "skipped", "message": str(e)})
+    except Exception as e:
+        record.update({"status": "error", "message": f"{type(e).__name__}: {e}"})
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    record["max_rss_bytes"] = _max_rss_bytes()
+    return record
+
+
+def run_isolated(name, size, repeat, seed):
+    """Runs one case in a new process so max_rss_bytes belongs to it alone."""
+    fd, path = tempfile.mkstemp(suffix=".jsonl")
+    os.close(fd)
+    try:
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--benchmarks", name, "--sizes", str(size),
+                        "--repeat", str(repeat), "--seed", str(seed), "--output", path, "--no-environment"],
+                       stdout=subprocess.DEVNULL, check=False)
+        records = read_records(path)
+    finally:
+        os.remove(path)
+    if records:
+        return records[0]
+    return {"benchmark": name, "pipeline": benchmarks[name]["pipeline"], "size": size,
+            "unit": benchmarks[name]["unit"], "repeat": repeat, "seed": seed,
+            "status": "error", "message": "isolated process did not write a record"}
+
+
+def read_records(path):
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def select(names):
+    """Benchmarks matching names (benchmark or pipeline names), all if empty."""
+    if not names:
+        return list(benchmarks.values())
+    selected = [spec for spec in benchmarks.values() if spec["name"] in names or spec["pipeline"] in names]
+    unknown = set(names) - {spec["name"] for spec in benchmarks.values()} - {spec["pipeline"] for spec in benchmarks.values()}
+    if unknown:
+        raise ValueError(f"Unknown benchmarks {sorted(unknown)}, see --list.")
+    return selected
+
+
+def compare(records, baseline, tolerance=0.2):
+    """Compares the median time and traced peak memory of records against
+    the latest baseline record of each (benchmark, size). Returns a
+    dataframe with the ratios and a regression flag for ratios above
+    1 + tolerance."""
+    latest = {}
+    for record in baseline:
+        if record.get("status") == "ok":
+            latest[(record["benchmark"], record["size"])] = record
+    rows = []
+    for record in records:
+        base = latest.get((record["benchmark"], record["size"]))
+        if record.get("status") != "ok" or base is None:
+            continue
+        time_ratio = record["median_seconds"] / base["median_seconds"] if base["median_seconds"] else np.nan
+        memory_ratio = (record["peak_traced_bytes"] / base["peak_traced_bytes"]
+                        if base.get("peak_traced_bytes") else np.nan)
+        rows.append({"benchmark": record["benchmark"], "size": record["size"],
+                     "baseline_seconds": base["median_seconds"], "seconds": record["median_seconds"],
+                     "time_ratio": time_ratio, "memory_ratio": memory_ratio,
+                     "regression": bool(time_ratio > 1 + tolerance or memory_ratio > 1 + tolerance)})
+    return pd.DataFrame(rows, columns=["benchmark", "size", "baseline_seconds", "seconds", "time_ratio",
+                                       "memory_ratio", "regression"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--benchmarks", nargs="*", default=[],
+                        help="benchmark or pipeline names (psm, bias_crimes, gender_disparity), default all")
+    parser.add_argument("--sizes", nargs="*", type=int, help="data sizes, default the benchmark's own")
+    parser.add_argument("--quick", action="store_true", help="small sizes for a fast smoke run")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.jsonl", help="JSON lines file records are appended to")
+    parser.add_argument("--compare", help="JSON lines file of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before a regression is flagged")
+    parser.add_argument("--isolate", action="store_true", help="run every case in its own process")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks and exit")
+    parser.add_argument("--no-environment", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for spec in benchmarks.values():
+            print(f"{spec['name']} ({spec['pipeline']}, {spec['unit']} {spec['sizes']}): {' '.join(spec['doc'].split())}")
+        return 0
+
+    warnings.simplefilter("ignore")
+    run_id = uuid.uuid4().hex[:12]
+    started = datetime.now().isoformat()
+    environment = {} if args.no_environment else _environment()
+    records = []
+    for spec in select(args.benchmarks):
+        sizes = args.sizes or (spec["quick_sizes"] if args.quick else spec["sizes"])
+        for size in sizes:
+            if args.isolate:
+                record = run_isolated(spec["name"], size, args.repeat, args.seed)
+            else:
+                record = run_case(spec, size, args.repeat, args.seed)
+            record.update({"run_id": run_id, "started": started, **environment})
+            records.append(record)
+            with open(args.output, "a") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+            if record["status"] == "ok":
+                print(f"{spec['name']:28s} {size:>9d} {spec['unit']:14s} median {record['median_seconds']:9.3f}s  "
+                      f"peak {record['peak_traced_bytes'] / 2**20:9.1f} MB")
+            else:
+                print(f"{spec['name']:28s} {size:>9d} {spec['unit']:14s} {record['status']}: {record.get('message')}")
+
+    if args.compare:
+        comparison = compare(records, read_records(args.compare), args.tolerance)
+        print(comparison.to_string(index=False))
+        if comparison["regression"].any():
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+"""Synthetic data generators with the schemas of the pipeline inputs.
+
+The generated frames have the columns and dtypes of the files the pipelines
+read, with value distributions that are plausible enough for the code paths
+(group sizes, one-hot widths, missing values) to behave like the real data:
+
+- terry_stops_model_features: model_features.csv (Public PSM)
+- incident_offense: incident_offense.csv (Public Bias Crimes)
+- narratives: narratives.csv (Public Bias Crimes)
+- disparity_data: disparity_data.csv (Public Gender Disparity)
+
+Every generator takes a seed and returns the same frame for the same seed.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _project in ("Public PSM", "Public Bias Crimes", "Public Gender Disparity"):
+    _path = os.path.join(repo_dir, _project)
+    if _path not in sys.path:
+        sys.path.append(_path)
+
+from public_psm_commonfunctions import precinct_watch, vectorized_watch_from_squad_desc
+from public_psm_incremental import (lookback_periods, percent_feature_specs,
+                                    subject_feature_specs, weapon_feature_specs)
+
+psm_precincts = ["NORTH", "EAST", "SOUTH", "WEST", "SOUTHWEST"]
+
+subject_races = ["White", "Black or African American", "Hispanic", "Asian",
+                 "American Indian or Alaska Native", "Multi-Racial",
+                 "Native Hawaiian or Other Pacific Islander", "Other"]
+subject_race_shares = [0.48, 0.30, 0.06, 0.05, 0.03, 0.04, 0.02, 0.02]
+
+weapon_types = ["None", "-", "Lethal Cutting Instrument", "Handgun", "Knife/Cutting/Stabbing Instrument",
+                "Blunt Object/Striking Implement", "Personal Weapons (hands, feet, etc.)", "Other Firearm"]
+weapon_type_shares = [0.55, 0.30, 0.05, 0.03, 0.03, 0.02, 0.01, 0.01]
+
+call_types = ["SUSPICIOUS PERSON, VEHICLE OR INCIDENT", "ASLT - PERSON SHOT OR SHOT AT", "THEFT - SHOPLIFT",
+              "TRESPASS", "DISTURBANCE, MISCELLANEOUS/OTHER", "BURG - RES (INCL UNOCC STRUCTURES)",
+              "WARRANT - FELONY PICKUP", "ROBBERY - ARMED", "-"]
+
+stop_resolutions = ["Field Contact", "Offense Report", "Arrest", "Referred for Prosecution", "Citation / Infraction"]
+age_groups = ["1 - 17", "18 - 25", "26 - 35", "36 - 45", "46 - 55", "56 and Above", "-"]
+officer_races = ["White", "Black or African American", "Hispanic or Latino", "Asian",
+                 "Two or More Races", "Nat Hawaiian/Oth Pac Islander", "Not Specified"]
+squad_suffixes = ["1ST W - B/N", "2ND W - E/G", "3RD W - K/M", "1ST W - S/R", "2ND W - D/M", "3RD W - B/N"]
+sectors = list("BCDEFGJKLMNOQRSUW")
+
+report_precincts = ["North", "East", "South", "West", "Southwest", "OOJ", "-"]
+victim_races = ["White", "Black or African American", "Asian", "American Indian or Alaska Native",
+                "Native Hawaiian or Other Pacific Islander", "Unknown", "-"]
+ethnicities = ["Not Hispanic Or Latino", "Hispanic Or Latino", "Unknown", "-"]
+genders = ["Male", "Female", "Gender Diverse (gender non-conforming and/or transgender)", "Unknown", "-"]
+crime_descriptions = ["RCW - 9A.36.080 | HATE CRIME OFFENSE", "RCW - 9A.36.080 | MALICIOUS HARASSMENT",
+                      "SMC - - 12A.06.115 | MALICIOUS HARASSMENT", "Incident Contains Bias Elements -- NO CRIME",
+                      "Offense Contains Bias Elements -- CRIME", "X91 | MALICIOUS HARASSMENT",
+                      "X92 | BIAS INCIDENT", "RCW - 9A.46.020.2B | HARASSMENT PREV CONV DEATH THREAT",
+                      "RCW - 9A.48.090 | MALICIOUS MISCHIEF 3RD DEGREE", "Crisis", "-"]
+approval_statuses = ["UCR Approved", "Draft", "Returned"]
+
+# words for synthetic narratives, common report vocabulary with a few terms
+# the bias crime model keys on
+narrative_vocabulary = (
+    "i was working patrol in a marked seattle police vehicle when dispatched to call located at "
+    "the victim stated that suspect approached him her them and yelled at said called threatened "
+    "punched pushed followed spit on car house window door street avenue store bus stop park "
+    "witness reported observed body worn video recording officer arrived contacted spoke with "
+    "identified arrested booked into king county jail for assault harassment malicious mischief "
+    "property damage graffiti slur racial religious sexual orientation gender identity because of "
+    "his her their race religion ethnicity national origin disability hate bias incident offense "
+    "report screened with sergeant photographs taken evidence collected statement provided no "
+    "injuries medics declined treatment case referred to detectives for follow up investigation"
+).split()
+
+disparity_race_columns = ["American Indian/Alaska Native", "Asian", "Black or African American", "Hispanic or Latino",
+                          "Nat Hawaiian/Oth Pac Islander", "Two or More Races", "Unknown", "White"]
+disparity_race_shares = [0.01, 0.08, 0.08, 0.07, 0.01, 0.04, 0.03, 0.68]
+
+
+def _format_datetime(timestamps):
+    """m/d/Y H:M strings, as the dates appear in the bias crime extracts."""
+    return (timestamps.dt.month.astype(str) + "/" + timestamps.dt.day.astype(str) + "/"
+            + timestamps.dt.year.astype(str) + " " + timestamps.dt.hour.astype(str) + ":"
+            + timestamps.dt.strftime("%M"))
+
+
+def terry_stops_model_features(n_rows, start="2017-01-01", end="2023-12-31", precincts=None,
+                               n_officers=None, n_subjects=None, seed=0):
+    """Frame with the columns of model_features.csv (the output of
+    public_psm_feature_engineering.ipynb), one row per stop.
+
+    The rolling count features are drawn at random rather than computed, so
+    large frames are cheap to generate; compute them with generate_features
+    or build_subject_features on the frame when they are what is measured.
+
+    Args:
+        n_rows (int): number of stops
+        start, end (str): range of observation_datetime_d
+        precincts (list): precincts to draw from, e.g. one precinct and a one
+                          month range for a single evaluate_all_stops cell
+        n_officers, n_subjects (int): number of distinct Officer IDs and
+                          Subject IDs, default to scale with n_rows
+        seed (int): random seed
+    """
+    rng = np.random.default_rng(seed)
+    precincts = psm_precincts if precincts is None else list(precincts)
+    n_officers = n_officers or max(10, n_rows // 40)
+    n_subjects = n_subjects or max(20, n_rows // 3)
+
+    start_ts, end_ts = pd.Timestamp(start), pd.Timestamp(end)
+    seconds = rng.integers(0, int((end_ts - start_ts).total_seconds()), n_rows)
+    observation = (start_ts + pd.to_timedelta(np.sort(seconds), unit="s")).floor("min")
+    observation = pd.Series(observation)
+
+    officer_ids = rng.integers(4000, 9000, n_officers)
+    officer = rng.integers(0, n_officers, n_rows)
+    precinct = np.asarray(precincts, dtype=object)[rng.integers(0, len(precincts), n_rows)]
+    squad = pd.Series(precinct + " PCT " + np.asarray(squad_suffixes, dtype=object)[rng.integers(0, len(squad_suffixes), n_rows)])
+    squad = squad.where(rng.random(n_rows) > 0.1, "TRAINING - FIELD TRAINING SQUAD")
+    subject_id = rng.integers(10000000000, 10000000000 + n_subjects, n_rows).astype(float)
+    subject_id[rng.random(n_rows) < 0.3] = np.nan
+    weapon = rng.choice(weapon_types, n_rows, p=weapon_type_shares)
+    sector = np.asarray(sectors, dtype=object)[rng.integers(0, len(sectors), n_rows)]
+
+    df = pd.DataFrame({
+        "Subject Age Group": rng.choice(age_groups, n_rows),
+        "Subject ID": subject_id,
+        "GO / SC Num": rng.integers(20170000000000, 20240000000000, n_rows),
+        "Terry Stop ID": np.arange(n_rows) + 10000000000,
+        "Stop Resolution": rng.choice(stop_resolutions, n_rows),
+        "Officer ID": officer_ids[officer].astype(str),
+        "Officer YOB": (1950 + officer_ids[officer] % 50),
+        "Officer Gender": np.where(officer_ids[officer] % 5 == 0, "F", "M"),
+        "Officer Race": np.asarray(officer_races, dtype=object)[officer_ids[officer] % len(officer_races)],
+        "Subject Perceived Race": rng.choice(subject_races, n_rows, p=subject_race_shares),
+        "Subject Perceived Gender": rng.choice(["Male", "Female", "Unknown"], n_rows, p=[0.78, 0.2, 0.02]),
+        "Initial Call Type": rng.choice(call_types, n_rows),
+        "Final Call Type": rng.choice(call_types, n_rows),
+        "Call Type": rng.choice(["911", "ONVIEW", "TELEPHONE OTHER, NOT 911", "-"], n_rows),
+        "Officer Squad": squad,
+        "Arrest Flag": rng.choice(["N", "Y"], n_rows, p=[0.9, 0.1]),
+        "Frisk Flag": rng.choice(["N", "Y"], n_rows, p=[0.77, 0.23]),
+        "Precinct": precinct,
+        "Sector": sector,
+        "Beat": sector + rng.integers(1, 4, n_rows).astype(str),
+        "weapon_type": (~np.isin(weapon, ["None", "-"])).astype(int),
+        "weapon_count": (~np.isin(weapon, ["None", "-"])).astype(int),
+        "observation_datetime_d": observation,
+    })
+    df["observation_year_d"] = observation.dt.year.astype(int)
+    df["observation_month_d"] = observation.dt.month.astype(int)
+    df["observation_day_d"] = observation.dt.day
+    df["observation_week_d"] = observation.dt.isocalendar().week.astype(int)
+    df["observation_time_d"] = observation.dt.time
+    df["observation_week_of_month_d"] = df["observation_day_d"] // 7
+    df["watch_d"] = vectorized_watch_from_squad_desc(df["Officer Squad"], df["observation_datetime_d"])
+    df["Precinct_watch_d"] = precinct_watch(df["Precinct"], df["watch_d"])
+
+    feature_names = [name for _, name in subject_feature_specs + weapon_feature_specs]
+    feature_names += [name for name, _, _ in percent_feature_specs]
+    for name in feature_names:
+        for period in lookback_periods:
+            if name.startswith("percent"):
+                values = rng.random(n_rows)
+            else:
+                values = rng.poisson(2 if "subject" in name else 30, n_rows).astype(float)
+            df[f"{name}_{period}"] = values
+    return df
+
+
+def model_features_as_read(df):
+    """Converts a terry_stops_model_features frame to the dtypes pandas gives
+    model_features.csv on read_csv (dates and times as strings), as used by
+    public_psm_app.ipynb."""
+    df = df.copy()
+    df["observation_datetime_d"] = df["observation_datetime_d"].astype(str)
+    df["observation_time_d"] = df["observation_time_d"].astype(str)
+    return df
+
+
+def incident_offense(n_reports, max_rows_per_report=4, start="2020-01-01", end="2024-06-30", seed=0):
+    """Frame with the columns of incident_offense.csv: one row per offense /
+    victim / subject combination of a report, between 1 and
+    max_rows_per_report rows per report."""
+    rng = np.random.default_rng(seed)
+    rows_per_report = rng.integers(1, max_rows_per_report + 1, n_reports)
+    n_rows = int(rows_per_report.sum())
+    report = np.repeat(np.arange(n_reports), rows_per_report)
+
+    start_ts, end_ts = pd.Timestamp(start), pd.Timestamp(end)
+    event_seconds = rng.integers(0, int((end_ts - start_ts).total_seconds()), n_reports)
+    event = pd.Series(start_ts + pd.to_timedelta(event_seconds, unit="s"))
+    submitted = event + pd.to_timedelta(rng.integers(600, 5 * 86400, n_reports), unit="s")
+    sector = np.asarray(sectors, dtype=object)[rng.integers(0, len(sectors), n_reports)]
+    beat = sector + rng.integers(1, 4, n_reports).astype(str)
+    precinct = rng.choice(report_precincts, n_reports, p=[0.25, 0.2, 0.2, 0.15, 0.15, 0.03, 0.02])
+
+    # the first row of a report is complete, later rows are often the partial
+    # rows ("-" offense, no people) of the extracts
+    first_row = np.concatenate(([0], np.cumsum(rows_per_report)[:-1]))
+    position = np.arange(n_rows) - np.repeat(first_row, rows_per_report)
+    partial = (position > 0) & (rng.random(n_rows) < 0.5)
+    def people(values):
+        column = np.asarray(rng.choice(values, n_rows), dtype=object)
+        column[partial] = None
+        return column
+    def ages():
+        column = rng.integers(-1, 80, n_rows).astype(float)
+        column[partial] = np.nan
+        return column
+
+    df = pd.DataFrame({
+        "report_id": (100000 + report),
+        "reporting_event_number": (65100000000 + report * 37),
+        "subject_ethnicity": people(ethnicities),
+        "subject_gender": people(genders),
+        "subject_personid": np.where(partial, np.nan, rng.integers(1, 100000, n_rows)),
+        "offense_id": np.where(partial, -1, rng.integers(1, 100000, n_rows)),
+        "offense_code_id": np.where(partial, -1, rng.integers(10000000000, 12000000000, n_rows)),
+        "subject_race": people(victim_races),
+        "subject_age": ages(),
+        "victim_age": ages(),
+        "victim_ethnicity": people(ethnicities),
+        "victim_gender": people(genders),
+        "victim_personid": np.where(partial, np.nan, rng.integers(1, 100000, n_rows)),
+        "victim_race": people(victim_races),
+        "beat": beat[report],
+        "sector": sector[report],
+        "crime_description": np.where(partial, "-", rng.choice(crime_descriptions, n_rows)),
+        "precinct": precinct[report],
+        "event_start_date": _format_datetime(event).to_numpy()[report],
+        "approval_status": rng.choice(approval_statuses, n_reports, p=[0.9, 0.07, 0.03])[report],
+        "report_submitted_date": _format_datetime(submitted).to_numpy()[report],
+        "report_ucr_approved_by": rng.integers(1000, 9999, n_reports)[report],
+    })
+    return df
+
+
+def narratives(n_reports, words_per_narrative=350, seed=0):
+    """Frame with the columns of narratives.csv: reporting_event_number,
+    report_id and a narrative of about words_per_narrative words in
+    sentences and paragraphs."""
+    rng = np.random.default_rng(seed)
+    vocabulary = np.asarray(narrative_vocabulary, dtype=object)
+    texts = []
+    for length in rng.poisson(words_per_narrative, n_reports):
+        words = vocabulary[rng.integers(0, len(vocabulary), max(int(length), 1))]
+        sentences = [" ".join(chunk).capitalize() + "." for chunk in np.array_split(words, max(len(words) // 15, 1))]
+        paragraphs = [" ".join(part) for part in np.array_split(np.asarray(sentences, dtype=object),
+                                                                max(len(sentences) // 5, 1))]
+        texts.append("\n\n".join(paragraphs))
+    return pd.DataFrame({
+        "reporting_event_number": 65100000000 + np.arange(n_reports) * 37,
+        "report_id": 100000 + np.arange(n_reports),
+        "narrative": texts,
+    })
+
+
+def disparity_data(n_rows, seed=0):
+    """Frame with the columns of disparity_data.csv, one row per employee.
+    gender_binary depends on some of the covariates, so the propensity model
+    has something to fit."""
+    rng = np.random.default_rng(seed)
+    year_of_birth = rng.integers(1945, 2000, n_rows)
+    highest_rank = rng.integers(1, 16, n_rows)
+    hours = rng.gamma(4, 4000, n_rows).round(2)
+    rate = rng.normal(100, 12, n_rows).round(2)
+    race = rng.choice(len(disparity_race_columns), n_rows, p=disparity_race_shares)
+    logit = -1.2 + 0.08 * (highest_rank - 8) + 0.02 * (year_of_birth - 1970) - 0.00002 * (hours - 16000)
+    gender = (rng.random(n_rows) < 1 / (1 + np.exp(-logit))).astype(int)
+    complaints = rng.poisson(2 + 0.3 * gender, n_rows)
+
+    df = pd.DataFrame({
+        "employee_id": 10000 + np.arange(n_rows),
+        "gender_binary": gender,
+        "Cad Count": rng.negative_binomial(1, 0.002, n_rows),
+        "Complaints Count Sus": np.minimum(complaints, rng.poisson(1.5, n_rows)),
+        "Complaints Count": complaints,
+        "Highest Rank": highest_rank,
+        "Io Report Count": rng.negative_binomial(1, 0.01, n_rows),
+        "Dollars Earned (Gross)": (hours * rate * rng.uniform(0.9, 1.1, n_rows)).round(2),
+        "Certifications Count": rng.poisson(0.5, n_rows),
+        "Unit Count": rng.integers(1, 6, n_rows),
+        "Military Experience": rng.integers(0, 2, n_rows),
+        "Hours Worked": hours,
+        "Max. Comp. Rate": rate,
+        "Promotion Count": rng.poisson(0.6, n_rows),
+    })
+    for i, column in enumerate(disparity_race_columns):
+        df[column] = (race == i).astype(int)
+    df["Last Pay Year"] = rng.integers(2016, 2025, n_rows)
+    df["Year of Birth"] = year_of_birth
+    return df